@@ -7,32 +7,99 @@ import random
 import pickle
 import bz2
 from pathlib import Path
+import multiprocessing as mp
+import json
 
 import numpy as np
 
+from compiled import CompiledCorpus, RunningCounts, compiled_path, is_compiled, read_header
+
 import sys
 if 'ipykernel' in sys.modules:
 	from tqdm.notebook import tqdm, trange
 else:
 	from tqdm import tqdm, trange
 
+def shannon_entropy(counts): # First-order entropy straight from an array of counts
+	counts = np.asarray(counts, dtype=np.float64).ravel()
+	counts = counts[counts > 0] # By convention, 0 × log2(0) = 0
+	if not len(counts): return 0.0
+	p = counts / counts.sum()
+	return float(-np.sum(p * np.log2(p)))
+
+def conditional_entropy(bigrams, rows=None, contexts=None): # H(Y|X) straight from an array of counts
+	# `bigrams` can be a dense 2D array (context × syllable), a scipy.sparse matrix, or a flat array of counts with `rows` giving each one's context
+	# `contexts` defaults to the row sums, which is what Analysis.count_contexts produces anyway
+	if hasattr(bigrams, 'tocoo'): # scipy.sparse, without having to import it
+		coo = bigrams.tocoo()
+		bigrams, rows = coo.data, coo.row
+	bigrams = np.asarray(bigrams, dtype=np.float64)
+	if rows is None:
+		if bigrams.ndim != 2: raise ValueError('Need either a 2D array or a row for each bigram', bigrams.shape)
+		rows = np.repeat(np.arange(bigrams.shape[0]), bigrams.shape[1])
+	bigrams = bigrams.ravel()
+	rows = np.asarray(rows).ravel()
+	if contexts is None: contexts = np.bincount(rows, weights=bigrams)
+	contexts = np.asarray(contexts, dtype=np.float64)
+	
+	cx = contexts[rows]
+	keep = (bigrams > 0) & (cx > 0) # Convention as in Analysis.entropy2
+	if not keep.any(): return 0.0
+	pxy = bigrams[keep] / bigrams.sum()
+	px = cx[keep] / contexts.sum()
+	return float(-np.sum(pxy * np.log2(pxy / px)))
+
+def read_pickle(fn): # A pickled corpus, bz2-compressed or not
+	opener = bz2.open if str(fn).endswith('bz2') else open # Make sure we open the file the right way
+	with opener(fn, 'rb') as f:
+		return pickle.load(f)
+
+def as_seed_sequence(seed): # Accept None, an int, or a SeedSequence
+	if isinstance(seed, np.random.SeedSequence): return seed
+	return np.random.SeedSequence(seed)
+
+def python_random(seed): # A `random.Random` seeded from a SeedSequence, for the code that samples from lists of strings
+	return random.Random(int.from_bytes(seed.generate_state(4).tobytes(), 'little'))
+
+_worker = None # The Analysis object that tasks run on; in a pool, each worker process gets it once, when it starts
+
+def _init_worker(analysis):
+	global _worker
+	_worker = analysis
+
+def _run_task(task): # A task is (method name, arguments, SeedSequence), and the method returns a list of (x, y) pairs
+	name, args, seed = task
+	_worker.rng = np.random.default_rng(seed) # Both random streams come from the task's own seed, so it doesn't matter which process runs it
+	_worker.random = python_random(seed)
+	return getattr(_worker, name)(*args)
+
 class Analysis: # Simplest version of the analysis, takes a Counter mapping words to counts
 	
-	def __init__(self, log=True, progbar=True, boundary='␣', divider='-', csize=None, smoothing=0): # Configuration parameters go here
+	def __init__(self, log=True, progbar=True, boundary='␣', divider='-', csize=None, smoothing=0, vectorized=False, seed=None): # Configuration parameters go here
 		self.log = log
 		self.progbar = progbar
 		self.boundary = boundary # Something that doesn't appear in any transcriptions
 		self.divider = divider # The symbol used to separate syllables
 		self.csize = csize # Corpus size (if we want to lower it)
 		self.smoothing = smoothing # Laplace smoothing
+		self.vectorized = vectorized # Count with integer arrays (see compiled.py) instead of Counters of strings
+		self.seed = as_seed_sequence(seed) # Everything random comes from this (if it's None, fresh entropy gets chosen and recorded here)
+		self.rng = np.random.default_rng(self.seed) # Used for sampling in vectorized mode
+		self.random = python_random(self.seed) # Used for sampling otherwise
 	
 	def special_loading_code(self): # Anything special to be done to the corpus
 		pass
 	
-	def load_corpus(self, fn):
-		opener = bz2.open if str(fn).endswith('bz2') else open # Make sure we open the file the right way
-		with opener(fn, 'rb') as f:
-			self.corpus = pickle.load(f)
+	def loading_signature(self): # Everything that affects how a file turns into a compiled corpus, so stale compiled files don't get used
+		return {'class': type(self).__name__, 'boundary': self.boundary, 'divider': self.divider}
+	
+	def load_corpus(self, fn, use_compiled=True):
+		if use_compiled: # Use the compiled version of the corpus (see compiled.py) instead, if there's an up-to-date one
+			cfn = fn if is_compiled(fn) else compiled_path(fn)
+			if cfn == fn or (Path(cfn).exists() and (not Path(fn).exists() or Path(cfn).stat().st_mtime >= Path(fn).stat().st_mtime) and read_header(cfn)['meta'].get('signature') == self.loading_signature()): # (Without the pickle, the compiled file is all there is)
+				return self.load_compiled(cfn)
+		
+		self.corpus = read_pickle(fn)
 		if self.log: print(f'Loaded {len(self.corpus)} words from {fn}')
 		
 		self.special_loading_code()
@@ -43,8 +110,54 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		self.tokens = tokens
 		
 		self.original_corpus = self.corpus # For reduction experiments
+		
+		if self.vectorized: self.compile_corpus()
+	
+	def load_compiled(self, fn):
+		self.compiled = CompiledCorpus.load(fn)
+		if self.compiled.meta.get('signature') != self.loading_signature():
+			print(f'Warning: {fn} was compiled with different settings', self.compiled.meta.get('signature'))
+		self.weights = self.original_weights = self.compiled.counts
+		self.tokens = int(self.compiled.counts.sum())
+		self.corpus = None if self.vectorized else self.compiled.to_dict() # Vectorized mode never needs the strings
+		self.original_corpus = self.corpus
+		if self.log: print(f'Loaded {len(self.compiled)} words from {fn}\nTypes: {len(self.compiled)} Tokens: {self.tokens}')
+	
+	def save_compiled(self, fn, compression=None, source=None): # See compiled.py for the format
+		if not hasattr(self, 'compiled'): self.compile_corpus()
+		self.compiled.save(fn, compression=compression, signature=self.loading_signature(), source=None if source is None else str(source))
+	
+	def share_corpus(self): # Move the compiled corpus into shared memory, and return the name other processes can attach_corpus() with
+		self.compiled = self.compiled.share()
+		self.weights = self.original_weights = self.compiled.counts
+		return self.compiled.shm.name
+	
+	def attach_corpus(self, name): # Use a compiled corpus that another process shared, without copying it
+		self.compiled = CompiledCorpus.attach(name)
+		self.weights = self.original_weights = self.compiled.counts
+		self.tokens = int(self.compiled.counts.sum())
+		self.corpus = self.original_corpus = None # Only vectorized mode can work from this
+	
+	def use_counts(self, vector): # Analyze a CountVector (see compiled.py) as if it had been loaded, without going through a Counter
+		if not self.vectorized: raise ValueError('Count vectors need vectorized mode')
+		self.compiled = vector.compiled
+		self.weights = self.original_weights = vector.counts
+		self.tokens = vector.tokens
+		self.corpus = self.original_corpus = None
+	
+	def __getstate__(self): # What gets sent to worker processes when they can't be forked
+		state = self.__dict__.copy()
+		if self.vectorized: state['corpus'] = state['original_corpus'] = None # Workers only need the compiled arrays (which pickle as a reference if they're shared)
+		return state
+	
+	def compile_corpus(self): # Intern every syllable once, so counting never has to split strings again
+		self.compiled = CompiledCorpus.from_counter(self.corpus, self.boundary, self.divider)
+		self.weights = self.compiled.counts # Current count of each word type
+		self.original_weights = self.weights
+		if self.log: print(f'Compiled {len(self.compiled)} words, {len(self.compiled.syllables)-1} syllables, {len(self.compiled.pair_codes)} bigrams')
 	
 	def inflate_corpus(self): # Call this once before doing any reductions
+		if self.vectorized: return # Vectorized mode samples from the count vector directly, so there's nothing to inflate
 		self.inflated_corpus = []
 		for word, count in self.corpus.items():
 			for _ in range(count):
@@ -52,9 +165,11 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 	
 	def reduce_corpus(self, desired_size=None, reduce_by=None, bootstrap=False):
 		
-		self.corpus = Counter(self.corpus) # HACK TODO FIX
-		
-		current_size = sum(self.corpus.values())
+		if self.vectorized: # Only self.weights changes in vectorized mode; self.corpus stays as it was loaded
+			current_size = int(self.weights.sum())
+		else:
+			self.corpus = Counter(self.corpus) # HACK TODO FIX
+			current_size = sum(self.corpus.values())
 		
 		if (reduce_by is None) == (desired_size is None): # == is xnor for bools
 			raise ValueError('Must supply exactly one of desired_size or reduced_by')
@@ -68,15 +183,20 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		if desired_size <= 0:
 			raise ValueError(desired_size)
 		
+		if self.vectorized:
+			self.weights = self.sample_weights(desired_size, bootstrap)
+			if self.log: print(f'Created reduced corpus of size {self.weights.sum()}')
+			return
+		
 		invert = (reduce_by < desired_size and not bootstrap) # For efficiency, it's sometimes better to select the data points to _remove_ instead of the ones to keep.
 		sample_size = reduce_by if invert else desired_size
 		
 		if bootstrap:
 			words = list(self.corpus.keys())
 			weights = [self.corpus[w] for w in words]
-			raw_sample = random.choices(words, weights, k=sample_size)
+			raw_sample = self.random.choices(words, weights, k=sample_size)
 		else:
-			raw_sample = random.sample(self.inflated_corpus, sample_size)
+			raw_sample = self.random.sample(self.inflated_corpus, sample_size)
 		
 		sample = Counter()
 		for word in raw_sample:
@@ -89,12 +209,19 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		
 		if self.log: print(f'Created reduced corpus of size {sum(self.corpus.values())}')
 	
+	def sample_weights(self, size, bootstrap=False): # Draw new type counts straight from the current ones: O(types) memory instead of O(tokens)
+		if bootstrap: # Sampling with replacement
+			return self.rng.multinomial(size, self.weights / self.weights.sum())
+		else: # Sampling without replacement
+			return self.rng.multivariate_hypergeometric(self.weights, size)
+	
 	def autoreduce(self):
 		self.inflate_corpus()
 		if self.csize is not None: self.reduce_corpus(desired_size = self.csize)
 	
 	def unreduce(self):
 		self.corpus = self.original_corpus
+		if self.vectorized: self.weights = self.original_weights
 	
 	def split_bigrams(self, word):
 		if not word: return
@@ -112,7 +239,24 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		for syl in word.split(self.divider):
 			yield syl # Not using `yield from` just for clarity's sake
 	
+	def count_arrays(self): # All three counts in a single pass over the compiled corpus
+		self.unigram_counts, self.bigram_counts, self.context_counts = self.compiled.count_all(self.weights)
+		self.total_unigrams = int(self.unigram_counts.sum())
+		self.total_bigrams = int(self.bigram_counts.sum())
+		self.total_contexts = int(self.context_counts.sum())
+		# (If the Counters are needed, self.compiled.unigram_counter and friends will convert them)
+	
+	def count_all(self):
+		if self.vectorized:
+			self.count_arrays()
+			if self.log: print(f'Found {self.total_unigrams} unigrams, {self.total_bigrams} bigrams, {self.total_contexts} contexts')
+			return
+		self.count_unigrams()
+		self.count_bigrams()
+		self.count_contexts()
+	
 	def count_bigrams(self):
+		if self.vectorized: return self.count_all()
 		self.bigrams = Counter()
 		for word, count in self.corpus.items():
 			for bg in self.split_bigrams(word):
@@ -121,6 +265,7 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		if self.log: print(f'Found {self.total_bigrams} bigrams, {len(self.bigrams)} unique')
 	
 	def count_unigrams(self):
+		if self.vectorized: return self.count_all()
 		self.unigrams = Counter()
 		for word, count in self.corpus.items():
 			for ug in self.split_unigrams(word):
@@ -129,6 +274,7 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		if self.log: print(f'Found {self.total_unigrams} unigrams, {len(self.unigrams)} unique')
 	
 	def count_contexts(self):
+		if self.vectorized: return self.count_all()
 		self.contexts = Counter()
 		for word, count in self.corpus.items():
 			for (c,_) in self.split_bigrams(word):
@@ -146,6 +292,8 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		return self.contexts[context] / self.total_contexts
 	
 	def entropy1(self): # First-order entropy (Shannon entropy)
+		if self.vectorized: return shannon_entropy(self.unigram_counts)
+		
 		sum = 0
 		def p(x): return self.unigram_probability(x)
 		
@@ -156,6 +304,9 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 		return -sum
 	
 	def entropy2(self): # Second-order entropy (information density)
+		if self.vectorized: return conditional_entropy(self.bigram_counts, self.compiled.pair_contexts, self.context_counts)
+		
+		# The loops below are kept as the reference implementation for the vectorized version (see engine_test)
 		sum = 0
 		def p(x, y=None): # Overloaded to provide both p(x) and p(x,y)
 			if y is None: return self.context_probability(x)
@@ -169,75 +320,184 @@ class Analysis: # Simplest version of the analysis, takes a Counter mapping word
 	
 	def do_things(self):
 		self.autoreduce()
-		self.count_unigrams()
-		self.count_bigrams()
-		self.count_contexts()
+		self.count_all()
 		e1 = self.entropy1()
 		e2 = self.entropy2()
 		return e1, e2
 	
-	def calculate_reduced_e2(self, n=1, bottom=5_000, top=None, npts=100, save=None, logscale=True, bootstrap=False, cut_top=False):
+	def calculate_reduced_e2(self, n=1, bottom=5_000, top=None, npts=100, save=None, logscale=True, bootstrap=False, cut_top=False, nested=False, workers=None, seed=None):
 		if top is None: top = self.tokens
-		if logscale:
-			lb = np.log10(bottom)
-			lt = np.log10(top)
-			xs = np.logspace(lb, lt, npts)
-		else:
-			xs = np.linspace(bottom, top, npts)
-		xs = np.rint(xs).astype(int) # We need integers only
-		np.random.shuffle(xs) # Shuffle it to make the progress bar work better
-		data = []
+		xs = self.sweep_sizes(bottom, top, npts, logscale)
 		self.inflate_corpus()
 		if cut_top:
 			self.reduce_corpus(desired_size=top, bootstrap=False)
 			self.original_corpus = self.corpus
+			if self.vectorized: self.original_weights = self.weights
 			self.inflate_corpus()
-		for x in tqdm(xs):
-			for _ in tqdm(range(n), leave=False, disable=(n<2)):
-				self.reduce_corpus(desired_size=x, bootstrap=bootstrap)
-				self.count_unigrams()
-				self.count_bigrams()
-				self.count_contexts()
-				y = self.entropy2()
-				data.append((x,y))
-				self.unreduce()
+		root = self.task_seed(seed)
+		if nested: # Opt-in, because the points on each curve are then nested samples rather than independent draws
+			if not self.vectorized: raise ValueError('Nested sweeps need vectorized=True')
+			seeds = root.spawn(n) # Every task gets its own independent random stream
+			tasks = [('nested_sweep', (xs, bootstrap), s) for s in seeds]
+		else:
+			seeds = root.spawn(len(xs) * n)
+			tasks = [('reduced_point', (x, bootstrap), s) for x, s in zip(np.repeat(xs, n), seeds)]
+			self.rng.shuffle(tasks) # Shuffle them to make the progress bar work better (this doesn't change which seed goes with which size)
+		data = self.run_tasks(tasks, workers)
 		
 		data.sort() # Undo the shuffling we did earlier
 		
-		if save is not None: # Save to a file
-			opener = bz2.open if str(save).endswith('bz2') else open # Make sure we open the file the right way
-			with opener(save, 'wb') as f:
-				pickle.dump(data, f)
-		
+		if save is not None: self.save_data(data, save, root)
 		return data
 	
-	def bootstrap_for_confidence(self, n, save=None):
-		self.inflate_corpus()
-		x = self.tokens
+	def sweep_sizes(self, bottom, top, npts, logscale=True): # The sample sizes for a reduction curve
+		if logscale:
+			lb = np.log10(bottom)
+			lt = np.log10(top)
+			xs = np.logspace(lb, lt, npts)
+		else:
+			xs = np.linspace(bottom, top, npts)
+		return np.rint(xs).astype(int) # We need integers only
+	
+	def sample_sweep(self, xs, running, bootstrap=False): # Grow one random sample through each size in xs (ascending), adding only the new tokens to every RunningCounts in running
+		remaining = self.weights.copy() # What hasn't been drawn yet, when sampling without replacement
+		probs = self.weights / self.weights.sum()
+		taken = 0
 		data = []
-		for _ in trange(n):
-			self.reduce_corpus(desired_size=x, bootstrap=True)
-			self.count_unigrams()
-			self.count_bigrams()
-			self.count_contexts()
-			y = self.entropy2()
-			data.append((x,y))
+		for x in xs:
+			if x < taken: raise ValueError('Sizes must be ascending', x, taken)
+			if bootstrap:
+				delta = self.rng.multinomial(x - taken, probs)
+			else: # Successive hypergeometric draws from what's left are the same as walking through one random permutation of the tokens
+				delta = self.rng.multivariate_hypergeometric(remaining, x - taken)
+				remaining -= delta
+			words = np.flatnonzero(delta)
+			for r in running: r.update(delta[words], words)
+			taken = x
+			data.append((x, tuple(r.entropy2() for r in running)))
+		return data
+	
+	def nested_sweep(self, xs, bootstrap=False): # One nested reduction curve, only ever counting the new tokens
+		return [(x, ys[0]) for x, ys in self.sample_sweep(xs, [RunningCounts(self.compiled)], bootstrap)]
+	
+	def reduced_point(self, x, bootstrap=False): # One point on a reduction curve
+		self.reduce_corpus(desired_size=x, bootstrap=bootstrap)
+		self.count_all()
+		y = self.entropy2()
+		self.unreduce()
+		return [(x, y)]
+	
+	def task_seed(self, seed=None): # The root for one experiment's task seeds: either the one given, or the next child of our own
+		if seed is None: return self.seed.spawn(1)[0]
+		return as_seed_sequence(seed)
+	
+	def save_data(self, data, save, seed): # Save results to a file, with the seed that produced them alongside
+		opener = bz2.open if str(save).endswith('bz2') else open # Make sure we open the file the right way
+		with opener(save, 'wb') as f:
+			pickle.dump(data, f)
+		with open(str(save) + '.seed.json', 'w') as f: # Rerun with seed=np.random.SeedSequence(entropy, spawn_key=spawn_key) for identical results
+			json.dump({'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}, f)
+	
+	def run_tasks(self, tasks, workers=None): # Run tasks (see _run_task) here or in a process pool, and gather their results in order
+		if workers is None or workers < 2:
+			rng, rand = self.rng, self.random
+			_init_worker(self)
+			data = [xy for task in tqdm(tasks) for xy in _run_task(task)]
+			self.rng, self.random = rng, rand
+			return data
 		
-		if save is not None: # Save to a file
-			opener = bz2.open if str(save).endswith('bz2') else open # Make sure we open the file the right way
-			with opener(save, 'wb') as f:
-				pickle.dump(data, f)
+		# Forking means the workers share our (already compiled) corpus instead of unpickling their own copy
+		ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+		temporary = None
+		weights, original_weights = self.weights, self.original_weights
+		if ctx.get_start_method() != 'fork' and self.vectorized and self.compiled.shm is None and self.compiled.path is None:
+			temporary = self.compiled # Otherwise every worker would get its own pickled copy of the arrays
+			self.compiled = temporary.share()
+			if weights is temporary.counts: self.weights = self.compiled.counts # Other weights (from use_counts, or cut_top) stay as they are
+			if original_weights is temporary.counts: self.original_weights = self.compiled.counts
+		try:
+			with ctx.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+				results = list(tqdm(pool.imap(_run_task, tasks), total=len(tasks)))
+		finally:
+			if temporary is not None:
+				self.compiled.unlink()
+				self.compiled = temporary
+				self.weights, self.original_weights = weights, original_weights
+		return [xy for result in results for xy in result]
+	
+	def bootstrap_for_confidence(self, n, save=None, workers=None, seed=None):
+		self.inflate_corpus()
+		x = self.tokens
+		root = self.task_seed(seed)
+		data = self.run_tasks([('reduced_point', (x, True), s) for s in root.spawn(n)], workers) # Each replicate resamples the full corpus
 		
+		if save is not None: self.save_data(data, save, root)
 		return data
 	
 	def dump_frequencies(self, save=None):
-		arr = np.array(list(self.unigrams.values()))
+		if self.vectorized: arr = self.unigram_counts[self.unigram_counts > 0]
+		else: arr = np.array(list(self.unigrams.values()))
 		if save is not None:
 			opener = bz2.open if str(save).endswith('bz2') else open # Make sure we open the file the right way
 			with opener(save, 'wb') as f:
 				pickle.dump(arr, f)
 		return arr
 
+class MultiEraAnalysis(Analysis): # Every era of a diachronic corpus at once: the eras share their word counts and differ only in syllabification
+	# So each era gets compiled against the same count vector, and every sample drawn from it is measured in all eras, making comparisons between eras paired
+	
+	def __init__(self, log=True, progbar=True, boundary='␣', divider='-', seed=None):
+		super().__init__(log=log, progbar=progbar, boundary=boundary, divider=divider, vectorized=True, seed=seed)
+	
+	def load_table(self, fn): # A file from diasimify.Corpus.output_table
+		table = read_pickle(fn)
+		self.load_forms(table['forms'], table['counts'], table['eras'])
+	
+	def load_forms(self, forms, counts, eras=None): # forms is {era: [syllabified form of each lemma]}, all lined up with counts
+		self.eras = list(forms) if eras is None else list(eras)
+		self.era_corpora = {era:CompiledCorpus.from_words(forms[era], counts, self.boundary, self.divider) for era in self.eras}
+		self.compiled = self.era_corpora[self.eras[0]] # (For anything inherited that wants one)
+		self.weights = self.original_weights = self.compiled.counts
+		self.tokens = int(self.weights.sum())
+		self.corpus = self.original_corpus = None
+		if self.log: print(f'Loaded {len(self.eras)} eras of {len(self.weights)} lemmas, {self.tokens} tokens')
+	
+	def entropies(self): # {era: (H1, H2)} for the current weights
+		result = {}
+		for era in self.eras:
+			unigrams, pairs, contexts = self.era_corpora[era].count_all(self.weights)
+			result[era] = (shannon_entropy(unigrams), conditional_entropy(pairs, self.era_corpora[era].pair_contexts, contexts))
+		return result
+	
+	def era_point(self, x, bootstrap=False): # One sample of size x, measured in every era
+		self.reduce_corpus(desired_size=x, bootstrap=bootstrap)
+		ys = tuple(h2 for h1, h2 in self.entropies().values())
+		self.unreduce()
+		return [(x, ys)]
+	
+	def era_sweep(self, xs, bootstrap=False): # As nested_sweep, with the same growing sample counted in every era
+		return self.sample_sweep(xs, [RunningCounts(self.era_corpora[era]) for era in self.eras], bootstrap)
+	
+	def calculate_reduced_eras(self, n=1, bottom=5_000, top=None, npts=100, save=None, logscale=True, bootstrap=False, nested=False, workers=None, seed=None):
+		# Like calculate_reduced_e2, but returns {era: [(x, y)]}; with `save`, that's a folder, and each era's curve goes in its own file
+		if top is None: top = self.tokens
+		xs = self.sweep_sizes(bottom, top, npts, logscale)
+		root = self.task_seed(seed)
+		if nested:
+			tasks = [('era_sweep', (xs, bootstrap), s) for s in root.spawn(n)]
+		else:
+			seeds = root.spawn(len(xs) * n)
+			tasks = [('era_point', (x, bootstrap), s) for x, s in zip(np.repeat(xs, n), seeds)]
+			self.rng.shuffle(tasks) # (As in calculate_reduced_e2)
+		data = sorted(self.run_tasks(tasks, workers)) # Sorting whole points, not just sizes, so the shuffle can't change the order of replicates
+		
+		curves = {era:[(x, ys[i]) for x, ys in data] for i, era in enumerate(self.eras)}
+		if save is not None:
+			Path(save).mkdir(parents=True, exist_ok=True)
+			for era, curve in curves.items():
+				self.save_data(curve, Path(save)/f'{era}.pickle.bz2', root)
+		return curves
+
 def confidence_test():
 	input()
 	analyzer = Analysis(log=False)
@@ -266,6 +526,93 @@ def auth_test():
 		analyzer.load_corpus(auth)
 		analyzer.calculate_reduced_e2(logscale=True, npts=200, n=1, save=Path('math/latin_auth_complete_new')/auth.name, bootstrap=False)
 
+def leave_one_out(full, parts, analysis=None, save=None, **kwargs): # H1 and H2 of the full corpus minus each part in turn, all from one compiled vocabulary and without writing out any intermediate corpora
+	# The full-size estimates come from taking each part's counts out of the full corpus's running counts and putting them back, so each costs time in proportion to that part's vocabulary
+	# `full` is a filename or Counter, `parts` a dict of name to filename or Counter; with `save`, also a reduction curve for each, saved in that folder
+	if analysis is None: analysis = Analysis(log=False, progbar=False, vectorized=True)
+	names = list(parts)
+	corpora = [read_pickle(c) if isinstance(c, (str, Path)) else c for c in [full] + [parts[name] for name in names]]
+	compiled, vectors = CompiledCorpus.from_counters(corpora, analysis.boundary, analysis.divider)
+	for corpus, vector in zip(corpora, vectors): vector.check(tokens=sum(corpus.values()), types=sum(1 for count in corpus.values() if count))
+	del corpora
+	full, vectors = vectors[0], vectors[1:]
+	running = RunningCounts(compiled, full.counts)
+	results = {}
+	for name, part in zip(tqdm(names), vectors):
+		if not full.contains(part): raise ValueError(f'{name} isn\'t wholly contained in the full corpus')
+		words = np.flatnonzero(part.counts)
+		running.update(-part.counts[words], words)
+		results[name] = (running.entropy1(), running.entropy2())
+		running.update(part.counts[words], words)
+		if save is not None:
+			analysis.use_counts(full - part)
+			analysis.calculate_reduced_e2(save=Path(save)/f'{name}.pickle.bz2', **kwargs)
+	return results
+
+def auth_test_batched(): # auth_test, straight from the solo author corpora instead of the auth_complete_new pickles
+	input()
+	parts = {auth.name.split('.')[0]:auth for auth in Path('data/latin/auth_solo/').glob('*.pickle.bz2')}
+	results = leave_one_out('data/latin/phi5_complete_new.pickle.bz2', parts, save='math/latin_auth_complete_new', logscale=True, npts=200, n=1, bootstrap=False)
+	for name, (e1, e2) in sorted(results.items()):
+		print(f'{name}\tSE: {e1}\tID: {e2}')
+
+def eras_test(): # H1 and H2 of every era, then their reduction curves, from one table instead of a pickle per era
+	input()
+	analyzer = MultiEraAnalysis(log=True, progbar=True)
+	analyzer.load_table('data/latin/phi5_diachronic_table.pickle.bz2')
+	for era, (e1, e2) in analyzer.entropies().items():
+		print(f'{era}\tSE: {e1}\tID: {e2}')
+	analyzer.calculate_reduced_eras(logscale=True, npts=200, n=1, save='math/latin_eras', nested=True)
+
+def convert_corpus(fn, out=None, analysis=None, compression=None): # Save a compiled copy of a pickled corpus, next to it by default, so load_corpus picks it up
+	if analysis is None: analysis = Analysis(log=False)
+	analysis.load_corpus(fn, use_compiled=False)
+	analysis.compile_corpus()
+	if out is None: out = compiled_path(fn)
+	analysis.save_compiled(out, compression=compression, source=fn)
+	return out
+
+def convert_all():
+	input()
+	paths = list(Path('data/latin').glob('*.pickle.bz2'))
+	for folder in ('auth_solo', 'auth_complete_new', '90'):
+		paths.extend(Path('data/latin', folder).glob('*.pickle.bz2'))
+	for fn in tqdm(paths):
+		convert_corpus(fn)
+
+def engine_test(corpus=None, sizes=(5_000, 50_000, 500_000), tolerance=1e-9, tokens=1_000_000, seed=0):
+	# Check the vectorized engine against the reference Counter implementation, on the full corpus and some reductions
+	# corpus is a Counter or a corpus file; by default it's a synthetic one of `tokens` tokens, since PHI5 can't be redistributed
+	if corpus is None:
+		from benchmark import zipf_corpus # (Imported here, since benchmark imports this module)
+		corpus = zipf_corpus(tokens, seed=seed)
+		corpus[''] = 3 # An empty word, which both engines have to agree on too
+	ref = Analysis(log=False, progbar=False)
+	vec = Analysis(log=False, progbar=False, vectorized=True)
+	for analysis in (ref, vec):
+		if isinstance(corpus, dict):
+			analysis.corpus = analysis.original_corpus = Counter(corpus)
+			analysis.tokens = sum(corpus.values())
+			if analysis.vectorized: analysis.compile_corpus()
+		else:
+			analysis.load_corpus(corpus)
+	ref.inflate_corpus()
+	for size in (None,) + tuple(sizes):
+		if size is not None:
+			ref.reduce_corpus(desired_size=min(size, ref.tokens))
+			vec.corpus = vec.original_corpus = ref.corpus # Same sample for both
+			vec.compile_corpus()
+		ref.count_all()
+		vec.count_all()
+		if ref.unigrams + Counter() != vec.compiled.unigram_counter(vec.unigram_counts): raise ValueError('Unigrams differ', size)
+		if ref.bigrams + Counter() != vec.compiled.bigram_counter(vec.bigram_counts): raise ValueError('Bigrams differ', size)
+		if ref.contexts + Counter() != vec.compiled.context_counter(vec.context_counts): raise ValueError('Contexts differ', size)
+		for name in ('entropy1', 'entropy2'):
+			a, b = getattr(ref, name)(), getattr(vec, name)()
+			if abs(a - b) > tolerance: raise ValueError(name, size, a, b)
+		print(f'Size {size or ref.tokens}: OK')
+		ref.unreduce()
+
 def basic():
 	an = Analysis()
 	an.load_corpus('data/latin/phi5_new.pickle.bz2')
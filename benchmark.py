@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Timings for the hot paths of Analysis, on synthetic corpora (since PHI5 and CELEX can't be redistributed)
+# Results are saved as JSON, so a run before and after a change can be compared with compare()
+
+from collections import Counter
+from pathlib import Path
+from time import perf_counter
+import multiprocessing as mp
+import platform
+import resource
+import pickle
+import json
+import bz2
+import sys
+
+import numpy as np
+
+from analyze import Analysis
+
+def zipf_corpus(tokens, types=None, syllables=None, exponent=1.1, seed=0, divider='-'): # A Counter of syllabified words, with Zipfian word frequencies built from Zipfian syllables
+	rng = np.random.default_rng(seed)
+	if types is None: types = max(100, int(8 * tokens ** 0.6)) # Roughly Heaps' law
+	if syllables is None: syllables = max(50, int(types ** 0.45))
+	inventory = [f's{i}' for i in range(syllables)]
+	syl_p = 1 / np.arange(1, syllables+1) ** exponent
+	syl_p /= syl_p.sum()
+	
+	words = set()
+	while len(words) < types: # Draw word shapes until there are enough distinct ones
+		need = types - len(words)
+		lengths = rng.geometric(0.45, need * 2).clip(1, 6)
+		syls = rng.choice(syllables, size=int(lengths.sum()), p=syl_p)
+		for word in np.split(syls, np.cumsum(lengths)[:-1]):
+			words.add(divider.join(inventory[i] for i in word))
+			if len(words) >= types: break
+	words = sorted(words, key=lambda w: (len(w), w)) # Shorter words get the higher ranks, as in real languages (ties broken alphabetically, so the seed alone decides the corpus)
+	
+	word_p = 1 / np.arange(1, types+1) ** exponent
+	counts = rng.multinomial(tokens, word_p / word_p.sum())
+	return Counter({word:int(count) for word, count in zip(words, counts) if count})
+
+def synthetic_file(tokens, folder='bench_corpora', **kwargs): # Generate a corpus once and keep it as a pickle, like the real ones
+	path = Path(folder)
+	path.mkdir(parents=True, exist_ok=True)
+	fn = path / ('zipf_' + '_'.join(f'{k}{v}' for k, v in sorted(dict(tokens=tokens, **kwargs).items())) + '.pickle.bz2')
+	if not fn.exists():
+		corpus = zipf_corpus(tokens, **kwargs)
+		with bz2.open(fn, 'wb') as f:
+			pickle.dump(dict(corpus), f)
+	return fn
+
+def peak_rss_mb(): # Highest resident set size of this process so far
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10) # Bytes on macOS, kilobytes everywhere else
+
+def timed(results, step, amount, function, repeat=1): # Best of `repeat` runs; `amount` is how many tokens the step works through, for the throughput
+	best = float('inf')
+	for _ in range(repeat):
+		start = perf_counter()
+		function()
+		best = min(best, perf_counter() - start)
+	results.append({'step':step, 'seconds':best, 'tokens_per_second':amount / best if best > 0 else None, 'peak_rss_mb':peak_rss_mb()})
+
+def run_scale(tokens, vectorized=False, folder='bench_corpora', npts=20, repeat=1, seed=0): # Every step on one corpus; meant to run in a fresh process, so peak RSS belongs to this scale alone
+	fn = synthetic_file(tokens, folder, seed=seed)
+	an = Analysis(log=False, progbar=False, vectorized=vectorized, seed=seed)
+	steps = []
+	
+	timed(steps, 'load_corpus', tokens, lambda: an.load_corpus(fn, use_compiled=False), repeat)
+	timed(steps, 'inflate_corpus', tokens, an.inflate_corpus, repeat)
+	half = an.tokens // 2
+	def reduce():
+		an.reduce_corpus(desired_size=half)
+		an.unreduce()
+	timed(steps, 'reduce_corpus', half, reduce, repeat)
+	for name in ('count_unigrams', 'count_bigrams', 'count_contexts', 'count_all'):
+		timed(steps, name, an.tokens, getattr(an, name), repeat)
+	for name in ('entropy1', 'entropy2'):
+		timed(steps, name, an.tokens, getattr(an, name), repeat)
+	bottom = min(5_000, max(10, an.tokens // 100))
+	xs = np.rint(np.logspace(np.log10(bottom), np.log10(an.tokens), npts))
+	timed(steps, 'calculate_reduced_e2', int(xs.sum()), lambda: an.calculate_reduced_e2(bottom=bottom, npts=npts, seed=seed), repeat)
+	
+	if vectorized: # The compiled format only matters to the vectorized engine
+		compiled = Path(folder) / (fn.name.split('.')[0] + '.lsrc')
+		an.save_compiled(compiled)
+		timed(steps, 'load_compiled', an.tokens, lambda: an.load_corpus(compiled), repeat)
+	
+	return {'tokens':an.tokens, 'types':len(an.compiled) if vectorized else len(an.corpus), 'engine':'vectorized' if vectorized else 'dict', 'steps':steps}
+
+def _run_scale(args):
+	return run_scale(*args)
+
+def benchmark(scales=(10_000, 100_000, 1_000_000), engines=(False, True), out='benchmark.json', folder='bench_corpora', npts=20, repeat=1, seed=0):
+	# scales can go up to tens of millions of tokens; the dict engine gets slow (and large) well before that
+	runs = []
+	ctx = mp.get_context('spawn') # A fresh interpreter for every run, so each one's peak RSS is its own
+	for tokens in scales:
+		for vectorized in engines:
+			with ctx.Pool(1) as pool:
+				result = pool.apply(_run_scale, ((tokens, vectorized, folder, npts, repeat, seed),))
+			runs.append(result)
+			print(f'{tokens} tokens, {result["engine"]}: ' + ', '.join(f'{s["step"]} {s["seconds"]:.3f}s' for s in result['steps']))
+	
+	report = {'python':platform.python_version(), 'numpy':np.__version__, 'machine':platform.machine(), 'processor':platform.processor(), 'cpus':mp.cpu_count(), 'runs':runs}
+	if out is not None:
+		with open(out, 'w') as f:
+			json.dump(report, f, indent=1)
+	return report
+
+def compare(before, after): # Speedup of every step that appears in both reports (filenames or dicts)
+	reports = []
+	for report in (before, after):
+		if not isinstance(report, dict):
+			with open(report, 'r') as f:
+				report = json.load(f)
+		reports.append({(run['tokens'], run['engine'], step['step']):step for run in report['runs'] for step in run['steps']})
+	old, new = reports
+	for key in sorted(old.keys() & new.keys()):
+		a, b = old[key], new[key]
+		print('{}\t{}\t{}\t{:.4f}s → {:.4f}s\t×{:.2f}\t{:.0f} → {:.0f} MB'.format(*key, a['seconds'], b['seconds'], a['seconds'] / b['seconds'], a['peak_rss_mb'], b['peak_rss_mb']))
+
+if __name__ == '__main__': benchmark()
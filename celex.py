@@ -11,7 +11,7 @@ if 'ipykernel' in sys.modules:
 else:
 	from tqdm import tqdm
 
-from analyze import Analysis
+from analyze import Analysis, convert_corpus
 
 # Current results for English: 9.42676, 6.98057
 # Goal: 9.51, 7.09
@@ -37,6 +37,9 @@ class CelexAnalysis(Analysis):
 		self.freq = freq
 		self.phon = phon
 	
+	def loading_signature(self):
+		return {**super().loading_signature(), 'stress': self.stress, 'freq': self.freq, 'phon': self.phon, 'smoothing': self.smoothing}
+	
 	def select_form(self, word): # Return either a phonological form that includes stress, or one that does not.
 		if self.stress: return word['PhonStrs'+self.phon]
 		else: return word['PhonSyl'+self.phon]
@@ -95,6 +98,11 @@ def german_new():
 	analyzer.load_corpus('data/german.pickle.bz2')
 	analyzer.calculate_reduced_e2(logscale=True, npts=200, n=5, top=2_000_000, save='math/german_log_cut2.pickle.bz2', bootstrap=False, cut_top=True)
 
+def convert(): # Compiled copies for load_corpus to pick up (see compiled.py)
+	input()
+	convert_corpus('data/english.pickle.bz2', analysis=CelexAnalysis(log=False, **ENGLISH))
+	convert_corpus('data/german.pickle.bz2', analysis=CelexAnalysis(log=False, **GERMAN))
+
 def misc_stats():
 	an = CelexAnalysis(**GERMAN, log=False)
 	print('Number of syllables in top 20000 words')
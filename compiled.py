@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+# An integer-encoded version of a corpus, so that counting doesn't have to split strings every time
+# Every syllable is interned to an integer ID once, and every word type becomes a run of IDs in one flat array
+
+from collections import Counter
+from math import log2
+from pathlib import Path
+import json
+import struct
+import os
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+# Compression is optional, and only matters for the on-disk format
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+BOUNDARY_ID = 0 # The boundary symbol always gets ID 0; it only ever appears as a context
+
+# On-disk format: MAGIC, then the length of the JSON header as a little-endian uint64, then the header,
+# then each array's raw bytes, aligned so that every one of them can be memory-mapped in place
+MAGIC = b'LSRCORP1'
+ALIGN = 64
+ARRAYS = ('ids', 'offsets', 'counts', 'pair_codes', 'pair_index', 'syllable_offsets', 'syllable_bytes')
+
+def aligned(n):
+	return -(-n // ALIGN) * ALIGN
+
+def compiled_path(fn): # Where the compiled version of a pickled corpus lives
+	fn = Path(fn)
+	name = fn.name
+	for suffix in ('.pickle.bz2', '.pickle'):
+		if name.endswith(suffix):
+			name = name[:-len(suffix)]
+			break
+	return fn.with_name(name + '.lsrc')
+
+def is_compiled(fn):
+	try:
+		with open(fn, 'rb') as f:
+			return f.read(len(MAGIC)) == MAGIC
+	except OSError:
+		return False
+
+def read_header(fn):
+	with open(fn, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC: raise ValueError('Not a compiled corpus', fn)
+		size, = struct.unpack('<Q', f.read(8))
+		return parse_header(MAGIC + struct.pack('<Q', size) + f.read(size))
+
+def parse_header(buf):
+	buf = memoryview(buf).cast('B')
+	if bytes(buf[:len(MAGIC)]) != MAGIC: raise ValueError('Not a compiled corpus')
+	size, = struct.unpack('<Q', buf[len(MAGIC):len(MAGIC)+8])
+	header = json.loads(bytes(buf[len(MAGIC)+8:len(MAGIC)+8+size]).decode('utf-8'))
+	header['start'] = aligned(len(MAGIC) + 8 + size) # Where the arrays begin
+	return header
+
+class SharedBlock(shared_memory.SharedMemory):
+	def __del__(self): # Arrays made from this block can outlive it (at interpreter exit, say), and then it can't be closed yet
+		try:
+			self.close()
+		except (BufferError, OSError):
+			pass
+
+def attach_block(name): # Open an existing block without this process taking responsibility for deleting it
+	try:
+		return SharedBlock(name=name, track=False)
+	except TypeError: # Before Python 3.13 there's no track argument, and attaching always registers with the resource tracker, which would delete it out from under everyone else
+		register = resource_tracker.register
+		resource_tracker.register = lambda name, rtype: None
+		try:
+			return SharedBlock(name=name)
+		finally:
+			resource_tracker.register = register
+
+def compress(data, method):
+	if method == 'zstd':
+		if zstandard is None: raise ImportError('zstd compression needs the zstandard package')
+		return zstandard.ZstdCompressor().compress(data)
+	if method == 'lz4':
+		if lz4 is None: raise ImportError('lz4 compression needs the lz4 package')
+		return lz4.frame.compress(data)
+	raise ValueError('Unknown compression', method)
+
+def decompress(data, method):
+	if method == 'zstd':
+		if zstandard is None: raise ImportError('zstd compression needs the zstandard package')
+		return zstandard.ZstdDecompressor().decompress(data)
+	if method == 'lz4':
+		if lz4 is None: raise ImportError('lz4 compression needs the lz4 package')
+		return lz4.frame.decompress(data)
+	raise ValueError('Unknown compression', method)
+
+def xlog2x(a): # Elementwise a × log2(a), with 0 × log2(0) = 0
+	a = np.asarray(a, dtype=np.float64)
+	out = np.zeros_like(a)
+	np.log2(a, out=out, where=(a > 0))
+	return a * out
+
+def ranges(starts, lengths): # All the indices start[0]:start[0]+length[0], start[1]:start[1]+length[1], ... as one array
+	ends = np.cumsum(lengths)
+	return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - starts, lengths)
+
+class CompiledCorpus:
+	
+	def __init__(self, syllables, ids, offsets, counts, words=None, divider='-', pair_codes=None, pair_index=None, meta=None):
+		self.syllables = syllables # Syllable strings, indexed by ID
+		self.ids = ids # Syllable IDs of every word type, one word after another
+		self.offsets = offsets # Word i is ids[offsets[i]:offsets[i+1]]
+		self.counts = counts # Token count of each word type
+		self._words = words # The original strings, so we can line up other Counters with this one (rebuilt from the IDs if needed)
+		self.divider = divider
+		self.word_index = None # Built on demand, since most experiments never need it
+		self.meta = meta or {} # Anything recorded in the file header
+		self.path = None # Set if the arrays are memory-mapped from a file...
+		self.shm = None # ...or if they live in shared memory
+		if pair_codes is None:
+			self.index_pairs()
+		else: # Already worked out when the file was saved
+			self.lengths = np.diff(self.offsets)
+			self.pair_codes, self.pair_index = pair_codes, pair_index
+			self.pair_contexts = self.pair_codes // len(self.syllables)
+			self.pair_targets = self.pair_codes % len(self.syllables)
+	
+	@classmethod
+	def from_counter(cls, corpus, boundary='␣', divider='-'):
+		return cls.from_words(corpus.keys(), corpus.values(), boundary, divider)
+	
+	@classmethod
+	def from_words(cls, types, type_counts, boundary='␣', divider='-'): # Word types in the order given; the same word can appear more than once (as when two lemmas share a reflex), which counting doesn't mind
+		table = {boundary: BOUNDARY_ID}
+		syllables = [boundary]
+		ids = []
+		offsets = [0]
+		counts = []
+		words = []
+		for word, count in zip(types, type_counts):
+			for syl in (word.split(divider) if word else ()): # Empty words still count as tokens, they just have no syllables (see Analysis.split_bigrams)
+				if syl not in table:
+					table[syl] = len(syllables)
+					syllables.append(syl)
+				ids.append(table[syl])
+			offsets.append(len(ids))
+			counts.append(count)
+			words.append(word)
+		
+		return cls(syllables, np.array(ids, dtype=np.int32), np.array(offsets, dtype=np.int64), np.array(counts, dtype=np.int64), words, divider)
+	
+	@classmethod
+	def from_counters(cls, corpora, boundary='␣', divider='-'): # One vocabulary covering all of several corpora, and each corpus as a CountVector over it
+		union = {}
+		for corpus in corpora:
+			for word in corpus: union[word] = 0
+		compiled = cls.from_counter(union, boundary, divider)
+		return compiled, [CountVector(compiled, compiled.vectorize(corpus)) for corpus in corpora]
+	
+	@classmethod
+	def load(cls, fn, mmap=True): # Uncompressed files are memory-mapped rather than read, unless mmap=False
+		header = read_header(fn)
+		if header['compression'] is None:
+			if mmap: # Every process that maps the same file shares the same pages, instead of each having its own copy
+				corpus = cls.from_buffer(np.memmap(fn, dtype=np.uint8, mode='r'), header)
+				corpus.path = str(fn)
+				return corpus
+			with open(fn, 'rb') as f:
+				return cls.from_buffer(f.read(), header)
+		with open(fn, 'rb') as f:
+			f.seek(header['start'])
+			payload = decompress(f.read(), header['compression'])
+		return cls.from_buffer(payload, {**header, 'start': 0})
+	
+	@classmethod
+	def from_buffer(cls, buf, header=None): # Zero-copy: the arrays are read-only views into buf
+		if header is None: header = parse_header(buf)
+		arrays = {}
+		for name, info in header['arrays'].items():
+			dtype = np.dtype(info['dtype'])
+			arr = np.frombuffer(buf, dtype=dtype, count=info['nbytes'] // dtype.itemsize, offset=header['start'] + info['offset']).reshape(info['shape'])
+			arr.flags.writeable = False
+			arrays[name] = arr
+		
+		blob = arrays['syllable_bytes'].tobytes()
+		bounds = arrays['syllable_offsets']
+		syllables = [blob[a:b].decode('utf-8') for a, b in zip(bounds, bounds[1:])]
+		return cls(syllables, arrays['ids'], arrays['offsets'], arrays['counts'], divider=header['divider'],
+			pair_codes=arrays['pair_codes'], pair_index=arrays['pair_index'], meta=header['meta'])
+	
+	def to_bytes(self, compression=None, **meta): # The whole file format, as one bytes object
+		encoded = [syl.encode('utf-8') for syl in self.syllables]
+		arrays = {
+			'ids': self.ids,
+			'offsets': self.offsets,
+			'counts': self.counts,
+			'pair_codes': self.pair_codes,
+			'pair_index': self.pair_index,
+			'syllable_offsets': np.cumsum([0] + [len(e) for e in encoded]).astype(np.int64),
+			'syllable_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+		}
+		
+		layout = {}
+		payload = bytearray()
+		for name in ARRAYS:
+			arr = np.ascontiguousarray(arrays[name])
+			payload.extend(bytes(aligned(len(payload)) - len(payload))) # Padding
+			layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': len(payload), 'nbytes': arr.nbytes}
+			payload.extend(arr.tobytes())
+		if compression is not None: payload = compress(bytes(payload), compression)
+		
+		header = json.dumps({'compression': compression, 'divider': self.divider, 'arrays': layout, 'meta': meta}).encode('utf-8')
+		data = bytearray(MAGIC)
+		data.extend(struct.pack('<Q', len(header)))
+		data.extend(header)
+		data.extend(bytes(aligned(len(data)) - len(data)))
+		data.extend(payload)
+		return data
+	
+	def save(self, fn, compression=None, **meta): # compression can be None, 'zstd', or 'lz4'; meta goes in the header
+		fn = Path(fn)
+		tmp = fn.with_name(f'{fn.name}.{os.getpid()}.tmp') # Write then rename, since another process may have the old file memory-mapped, and truncating it would crash that process
+		with open(tmp, 'wb') as f:
+			f.write(self.to_bytes(compression, **meta))
+		tmp.replace(fn)
+	
+	def share(self): # A copy of this corpus in shared memory, which other processes can attach() to by name without copying it again
+		data = self.to_bytes(**self.meta)
+		shm = SharedBlock(create=True, size=len(data))
+		shm.buf[:len(data)] = data
+		corpus = CompiledCorpus.from_buffer(shm.buf)
+		corpus.shm = shm # Whoever called share() should call unlink() once everyone's done with it
+		return corpus
+	
+	@classmethod
+	def attach(cls, name): # Read-only access to a corpus another process share()d
+		shm = attach_block(name)
+		corpus = cls.from_buffer(shm.buf)
+		corpus.shm = shm
+		return corpus
+	
+	def unlink(self):
+		if self.shm is not None: self.shm.unlink()
+	
+	def __reduce_ex__(self, protocol): # When the arrays already live somewhere other processes can reach, pickle a reference instead of the data
+		if self.shm is not None: return (CompiledCorpus.attach, (self.shm.name,))
+		if self.path is not None: return (CompiledCorpus.load, (self.path,))
+		return super().__reduce_ex__(protocol)
+	
+	def index_pairs(self): # Work out which bigram each syllable position completes, once and for all
+		nsyl = len(self.syllables)
+		self.lengths = np.diff(self.offsets)
+		prev = np.empty_like(self.ids)
+		prev[1:] = self.ids[:-1]
+		prev[self.offsets[:-1][self.lengths > 0]] = BOUNDARY_ID # Use prefix, but not suffix, as clarified in Oh's thesis
+		codes = prev.astype(np.int64) * nsyl + self.ids # Pack each (context, syllable) pair into one integer
+		self.pair_codes, self.pair_index = np.unique(codes, return_inverse=True)
+		self.pair_index = self.pair_index.reshape(-1) # Some versions of numpy keep the input's shape here
+		if len(self.pair_codes) < 2**31: self.pair_index = self.pair_index.astype(np.int32) # Half the size, on disk and in memory
+		self.pair_contexts = self.pair_codes // nsyl
+		self.pair_targets = self.pair_codes % nsyl
+	
+	def __len__(self):
+		return len(self.counts)
+	
+	@property
+	def words(self):
+		if self._words is None: # Splitting on the divider and joining again gives back exactly the original string
+			syls = self.syllables
+			ids = self.ids.tolist()
+			self._words = [self.divider.join([syls[i] for i in ids[a:b]]) for a, b in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+		return self._words
+	
+	def to_dict(self, counts=None): # Back to the {word: count} form that the pickles use
+		if counts is None: counts = self.counts
+		return dict(zip(self.words, np.asarray(counts).tolist()))
+	
+	def word_id(self, word): # Position of a word type in our arrays
+		if self.word_index is None:
+			self.word_index = {word:i for i, word in enumerate(self.words)}
+		return self.word_index[word]
+	
+	def vectorize(self, corpus): # Turn a Counter over (a subset of) our word types into a count vector lined up with ours
+		counts = np.zeros(len(self), dtype=np.int64)
+		for word, count in corpus.items():
+			counts[self.word_id(word)] += count
+		return counts
+	
+	def count_pairs(self, counts=None): # Everything comes out of this single bincount over syllable positions
+		if counts is None: counts = self.counts
+		weights = np.repeat(counts, self.lengths)
+		pairs = np.bincount(self.pair_index, weights=weights, minlength=len(self.pair_codes))
+		return np.rint(pairs).astype(np.int64) # bincount always gives floats, but these are exact
+	
+	def count_all(self, counts=None): # Returns unigram, bigram, and context counts
+		pairs = self.count_pairs(counts)
+		nsyl = len(self.syllables)
+		unigrams = np.bincount(self.pair_targets, weights=pairs, minlength=nsyl)
+		contexts = np.bincount(self.pair_contexts, weights=pairs, minlength=nsyl)
+		return np.rint(unigrams).astype(np.int64), pairs, np.rint(contexts).astype(np.int64)
+	
+	def unigram_counter(self, unigrams): # Convert back to the Counters the rest of Analysis expects
+		return Counter({self.syllables[i]:int(unigrams[i]) for i in np.flatnonzero(unigrams)})
+	
+	def context_counter(self, contexts):
+		return Counter({self.syllables[i]:int(contexts[i]) for i in np.flatnonzero(contexts)})
+	
+	def bigram_counter(self, pairs):
+		syls = self.syllables
+		return Counter({(syls[self.pair_contexts[i]], syls[self.pair_targets[i]]):int(pairs[i]) for i in np.flatnonzero(pairs)})
+
+class CountVector: # A corpus as token counts over a CompiledCorpus's word types, so corpora with the same vocabulary combine with array arithmetic instead of Counter arithmetic
+	
+	def __init__(self, compiled, counts=None):
+		self.compiled = compiled
+		self.counts = compiled.counts if counts is None else np.asarray(counts, dtype=np.int64)
+		if self.counts.shape != (len(compiled),): raise ValueError('Counts don\'t match the vocabulary', self.counts.shape, len(compiled))
+	
+	def compatible(self, other):
+		if other.compiled is not self.compiled: raise ValueError('Count vectors over different vocabularies (see CompiledCorpus.from_counters)')
+	
+	def __add__(self, other):
+		self.compatible(other)
+		return CountVector(self.compiled, self.counts + other.counts)
+	
+	def __sub__(self, other): # Counter subtraction quietly drops anything that goes negative; this refuses instead
+		self.compatible(other)
+		counts = self.counts - other.counts
+		if (counts < 0).any():
+			bad = np.flatnonzero(counts < 0)
+			raise ValueError(f'Subtracting more tokens than there are of {len(bad)} word types', self.compiled.words[bad[0]])
+		return CountVector(self.compiled, counts)
+	
+	def restrict(self, keep): # Only some word types (a boolean mask, indices, or words), with everything else zeroed
+		if not isinstance(keep, np.ndarray) or keep.dtype != bool:
+			keep = list(keep)
+			if keep and isinstance(keep[0], str): keep = [self.compiled.word_id(word) for word in keep]
+			mask = np.zeros(len(self.counts), dtype=bool)
+			mask[np.asarray(keep, dtype=np.int64)] = True
+			keep = mask
+		return CountVector(self.compiled, np.where(keep, self.counts, 0))
+	
+	def contains(self, other): # Whether other could have been subtracted from this
+		self.compatible(other)
+		return bool((other.counts <= self.counts).all())
+	
+	@property
+	def tokens(self):
+		return int(self.counts.sum())
+	
+	@property
+	def types(self):
+		return int(np.count_nonzero(self.counts))
+	
+	def check(self, tokens=None, types=None): # Raise if the counts are negative, or don't add up to what's expected
+		if (self.counts < 0).any(): raise ValueError('Negative counts', int(self.counts.min()))
+		if tokens is not None and self.tokens != tokens: raise ValueError('Token count', self.tokens, tokens)
+		if types is not None and self.types != types: raise ValueError('Type count', self.types, types)
+		return self
+	
+	def to_dict(self): # Only the types that occur, as in the pickles
+		return {word:count for word, count in self.compiled.to_dict(self.counts).items() if count}
+
+class RunningCounts: # Syllable, bigram and context counts that can be updated a few word types at a time, keeping H(X) and H(Y|X) current
+	
+	def __init__(self, compiled, counts=None):
+		self.compiled = compiled
+		self.weights = np.zeros(len(compiled), dtype=np.int64) if counts is None else np.array(counts, dtype=np.int64)
+		self.unigrams, self.pairs, self.contexts = compiled.count_all(self.weights)
+		self.total = int(self.pairs.sum()) # Every syllable position is one unigram and one bigram, so this is N for both
+		# H(Y|X) = -(Σ c(x,y) log2 c(x,y) - Σ c(x) log2 c(x)) / N, so these two sums are all we need to keep track of
+		self.pair_sum = float(xlog2x(self.pairs).sum())
+		self.context_sum = float(xlog2x(self.contexts).sum())
+		# Likewise H(X) = log2 N - Σ c(x) log2 c(x) / N
+		self.unigram_sum = float(xlog2x(self.unigrams).sum())
+	
+	def update(self, deltas, words=None): # Add deltas[i] tokens of word type words[i] (or of type i, if words is None); deltas can be negative
+		deltas = np.asarray(deltas, dtype=np.int64)
+		if words is None:
+			words = np.flatnonzero(deltas)
+			deltas = deltas[words]
+		words = np.asarray(words)
+		c = self.compiled
+		lengths = c.lengths[words]
+		pos = ranges(c.offsets[words], lengths) # Only the syllable positions of the words that changed
+		touched, inverse = np.unique(c.pair_index[pos], return_inverse=True)
+		change = np.rint(np.bincount(inverse.reshape(-1), weights=np.repeat(deltas, lengths), minlength=len(touched))).astype(np.int64)
+		
+		old = self.pairs[touched]
+		new = old + change
+		if (new < 0).any(): raise ValueError('Removed more bigrams than there were', c.pair_codes[touched[new < 0]])
+		self.pair_sum += float(xlog2x(new).sum() - xlog2x(old).sum())
+		self.pairs[touched] = new
+		
+		self.context_sum += self.shift(self.contexts, c.pair_contexts[touched], change)
+		self.unigram_sum += self.shift(self.unigrams, c.pair_targets[touched], change)
+		
+		self.total += int(change.sum())
+		np.add.at(self.weights, words, deltas)
+	
+	def shift(self, counts, syls, change): # Add each bigram's change onto its context (or target) syllable in counts, and return the change in Σ c log2 c
+		syls, inverse = np.unique(syls, return_inverse=True)
+		change = np.rint(np.bincount(inverse.reshape(-1), weights=change, minlength=len(syls))).astype(np.int64)
+		old = counts[syls]
+		new = old + change
+		counts[syls] = new
+		return float(xlog2x(new).sum() - xlog2x(old).sum())
+	
+	def entropy1(self):
+		if self.total <= 0: return 0.0
+		return log2(self.total) - self.unigram_sum / self.total
+	
+	def entropy2(self):
+		if self.total <= 0: return 0.0
+		return -(self.pair_sum - self.context_sum) / self.total
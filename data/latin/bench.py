@@ -0,0 +1,103 @@
+# Time each stage of turning Latin text into syllabified words (and on into IPA and French syllables), to see where the time goes
+# Runs on sample.txt (Caesar, Cicero and Virgil, all public domain) by default, or on a PHI5 author if there's a copy of PHI5 around
+
+from pathlib import Path
+from time import perf_counter
+import cProfile
+import pstats
+import json
+
+try:
+	import pyinstrument
+except ImportError:
+	pyinstrument = None
+
+try:
+	from process import Processor, BOUNDARY
+	from diasimify import Lemma
+	from undiasimify import FrenchWord
+except ImportError:
+	from .process import Processor, BOUNDARY
+	from .diasimify import Lemma
+	from .undiasimify import FrenchWord
+
+SAMPLE = Path(__file__).parent / 'sample.txt'
+
+def sample_text(author=None): # The bundled sample, or the cleaned text of one PHI5 author (by ID, like 'LAT0474')
+	if author is None:
+		return SAMPLE.read_text(encoding='utf-8')
+	try: # (Imported here so the benchmark works without CLTK's PHI5 tools)
+		from corpus import PHI5Corpus
+	except ImportError:
+		from .corpus import PHI5Corpus
+	c = PHI5Corpus()
+	paths = c.get_filenames(authorial=True, include={author})
+	if not paths: raise ValueError('No PHI5 file for that author', author)
+	return c.get_text(paths[0])
+
+class Profiler: # Wraps each stage in cProfile or pyinstrument, if asked for, and saves one report per stage
+	
+	def __init__(self, kind=None, out='bench_profiles'):
+		if kind not in (None, 'cprofile', 'pyinstrument'): raise ValueError('Unknown profiler', kind)
+		if kind == 'pyinstrument' and pyinstrument is None: raise ImportError('pyinstrument is not installed')
+		self.kind = kind
+		self.out = Path(out)
+	
+	def run(self, name, function):
+		if self.kind is None: return function()
+		self.out.mkdir(parents=True, exist_ok=True)
+		if self.kind == 'cprofile':
+			prof = cProfile.Profile()
+			result = prof.runcall(function)
+			prof.dump_stats(self.out / f'{name}.prof')
+			pstats.Stats(prof).sort_stats('cumulative').print_stats(15)
+		else:
+			prof = pyinstrument.Profiler()
+			prof.start()
+			result = function()
+			prof.stop()
+			(self.out / f'{name}.html').write_text(prof.output_html(), encoding='utf-8')
+			print(prof.output_text(unicode=True))
+		return result
+
+def stage(results, profiler, name, count, function): # Time one stage; count is how many words it handles
+	start = perf_counter()
+	output = profiler.run(name, function)
+	seconds = perf_counter() - start
+	results.append({'stage':name, 'words':count, 'seconds':seconds, 'words_per_second':count / seconds if seconds > 0 else None})
+	print(f'{name:>16}: {count:>8} words in {seconds:8.3f}s = {count / seconds if seconds > 0 else float("inf"):>10.0f} words/s')
+	return output
+
+def benchmark(author=None, repeat=1, profile=None, out=None): # repeat makes the text that many times longer, to see how each stage scales
+	text = ' '.join([sample_text(author)] * repeat)
+	profiler = Profiler(profile)
+	results = []
+	
+	proc = stage(results, profiler, 'load', 1, Processor) # Mostly loading the macronizer's model
+	words = text.split()
+	macronized = stage(results, profiler, 'macronize', len(words), lambda: proc.macronize(text).split())
+	cleaned = stage(results, profiler, 'clean', len(macronized), lambda: [w for w in map(proc.clean, macronized) if w])
+	syllables = stage(results, profiler, 'syllabify', len(cleaned), lambda: [proc.syllabify(w) for w in cleaned])
+	joined = stage(results, profiler, 'join', len(syllables), lambda: [BOUNDARY.join(s) for s in syllables])
+	
+	stage(results, profiler, 'process (cold)', len(words), lambda: list(proc.process(text))) # The word cache starts out empty...
+	stage(results, profiler, 'process (cached)', len(words), lambda: list(proc.process(text))) # ...and this time every word is in it
+	
+	types = sorted(set(joined)) # The later stages work on types rather than tokens, as in diasimify.Corpus
+	lemmas = stage(results, profiler, 'ipa', len(types), lambda: [Lemma(w, 1) for w in types])
+	stage(results, profiler, 'french', len(lemmas), lambda: [FrenchWord(l.ipa, stress=False) for l in lemmas])
+	stage(results, profiler, 'french (kw)', len(lemmas), lambda: [FrenchWord(l.ipa, stress=False, kw_correction=True) for l in lemmas])
+	
+	if out is not None:
+		with open(out, 'w') as f:
+			json.dump({'author':author, 'repeat':repeat, 'stages':results}, f, indent=1)
+	return results
+
+def scaling(repeats=(1, 4, 16), author=None): # Words per second for each stage at several text lengths
+	table = {n:{r['stage']:r['words_per_second'] for r in benchmark(author, n)} for n in repeats}
+	for name in table[repeats[0]]:
+		print(f'{name:>16}: ' + '  '.join(f'×{n}: {table[n][name] or 0:10.0f}' for n in repeats))
+	return table
+
+if __name__ == '__main__':
+	benchmark(author=input('PHI5 author ID (blank for the bundled sample): ').strip() or None, profile=input('Profiler (blank, cprofile, or pyinstrument): ').strip() or None)
@@ -0,0 +1,149 @@
+# Content-addressed cache of per-file word Counters, so corpora built from overlapping sets of PHI5 files don't redo the same work
+# A file's entry is keyed by a hash of its contents plus a fingerprint of everything that turns text into counts
+
+import hashlib
+import bz2
+import pickle
+import os
+import struct
+import json
+import mmap
+from pathlib import Path
+
+def file_hash(fn):
+	h = hashlib.sha256()
+	with open(fn, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+class CountCache:
+	
+	def __init__(self, path='phi5_cache'):
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.hits = 0
+		self.misses = 0
+	
+	def location(self, fn, fingerprint):
+		key = hashlib.sha256((file_hash(fn) + fingerprint).encode('utf-8')).hexdigest()
+		return self.path / key[:2] / f'{key}.pickle.bz2'
+	
+	def get(self, fn, fingerprint): # Returns None if this file hasn't been processed with these settings before
+		loc = self.location(fn, fingerprint)
+		if not loc.exists():
+			self.misses += 1
+			return None
+		with bz2.open(loc, 'rb') as f:
+			counts = pickle.load(f)
+		self.hits += 1
+		return counts
+	
+	def put(self, fn, fingerprint, counts):
+		loc = self.location(fn, fingerprint)
+		loc.parent.mkdir(exist_ok=True)
+		tmp = loc.with_suffix('.tmp') # Write then rename, so an interrupted run never leaves a half-written entry
+		with bz2.open(tmp, 'wb') as f:
+			pickle.dump(counts, f)
+		tmp.replace(loc)
+
+class Journal: # Append-only log of the Counter for every file a build has finished, so an interrupted build can pick up where it stopped
+	
+	def __init__(self, path):
+		self.path = Path(path)
+	
+	def read(self): # Filename stem to Counter, for every complete record; a half-written record at the end gets cut off
+		done = {}
+		if not self.path.exists(): return done
+		good = 0
+		with open(self.path, 'rb') as f:
+			while True:
+				head = f.read(8)
+				if len(head) < 8: break
+				size, = struct.unpack('<Q', head)
+				payload = f.read(size)
+				if len(payload) < size: break
+				try:
+					stem, counts = pickle.loads(bz2.decompress(payload))
+				except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+					break
+				done[stem] = counts
+				good = f.tell()
+		if good < self.path.stat().st_size: # So new records go after the last good one
+			print(f'(Dropping {self.path.stat().st_size - good} bytes of incomplete record from {self.path})')
+			os.truncate(self.path, good)
+		return done
+	
+	def append(self, fn, counts): # One record per file: 8-byte length, then the bz2-compressed pickle of (stem, counts)
+		payload = bz2.compress(pickle.dumps((Path(fn).stem, counts), protocol=pickle.HIGHEST_PROTOCOL))
+		with open(self.path, 'ab') as f:
+			f.write(struct.pack('<Q', len(payload)) + payload)
+			f.flush()
+			os.fsync(f.fileno()) # Once this returns, the file counts as done even if the machine goes away
+
+class TextStore: # Cleaned texts back to back in one file, plus an index of where each one is; read through mmap, so a text that's been cleaned before costs neither I/O nor cleanup
+	
+	def __init__(self, path='phi5_texts', fingerprint=''):
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.data_fn = self.path / 'texts.bin'
+		self.index_fn = self.path / 'index.json'
+		self.fingerprint = fingerprint # Of the cleanup code: if that changes, every stored text is stale
+		self.index = {} # Author ID to offset, length, and the source file's mtime, size and hash
+		self.map = None
+		self.readonly = False # Set in worker processes, which can read but mustn't race each other to append
+		self.hits = 0
+		self.misses = 0
+		if self.index_fn.exists():
+			with open(self.index_fn, 'r') as f:
+				saved = json.load(f)
+			if saved['fingerprint'] == fingerprint: self.index = saved['texts']
+		if not self.index and self.data_fn.exists(): # Nothing in it is usable, so start over
+			os.truncate(self.data_fn, 0)
+	
+	def __getstate__(self): # An mmap can't be pickled; each process opens its own
+		state = self.__dict__.copy()
+		state['map'] = None
+		return state
+	
+	def valid(self, key, fn): # Whether the stored text was made from the file as it is now
+		entry = self.index.get(key)
+		if entry is None: return False
+		st = os.stat(fn)
+		if entry['size'] != st.st_size: return False
+		if entry['mtime'] == st.st_mtime_ns: return True
+		if entry['hash'] != file_hash(fn): return False
+		entry['mtime'] = st.st_mtime_ns # Touched but not changed, so don't hash it again next time
+		if not self.readonly: self.save()
+		return True
+	
+	def get(self, fn): # Returns None if this file isn't in the store or has changed since
+		key = Path(fn).stem
+		if not self.valid(key, fn):
+			self.misses += 1
+			return None
+		self.hits += 1
+		entry = self.index[key]
+		start, end = entry['offset'], entry['offset'] + entry['length']
+		if start == end: return ''
+		if self.map is None or len(self.map) < end: # Not opened yet in this process, or opened before this text was added
+			if self.map is not None: self.map.close()
+			with open(self.data_fn, 'rb') as f:
+				self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.map[start:end].decode('utf-8')
+	
+	def put(self, fn, text): # Appends; space used by a stale version of a text isn't reclaimed
+		if self.readonly: return
+		data = text.encode('utf-8')
+		with open(self.data_fn, 'ab') as f:
+			offset = f.tell()
+			f.write(data)
+		st = os.stat(fn)
+		self.index[Path(fn).stem] = {'offset':offset, 'length':len(data), 'mtime':st.st_mtime_ns, 'size':st.st_size, 'hash':file_hash(fn)}
+		self.save()
+	
+	def save(self): # The data file is only ever appended to, so the index is written after it, and atomically
+		tmp = self.index_fn.with_suffix('.tmp')
+		with open(tmp, 'w') as f:
+			json.dump({'fingerprint':self.fingerprint, 'texts':self.index}, f)
+		tmp.replace(self.index_fn)
@@ -5,6 +5,9 @@ import random
 import pickle
 import bz2
 from collections import Counter
+import multiprocessing as mp
+import hashlib
+import inspect
 
 from cltk.corpus.utils.formatter import assemble_phi5_author_filepaths, assemble_phi5_works_filepaths
 from cltk.corpus.utils.formatter import phi5_plaintext_cleanup
@@ -17,9 +20,11 @@ else:
 	from tqdm import tqdm, trange
 
 try:
-	from process import Processor
+	from process import Processor, chunks
+	from cache import CountCache, Journal, TextStore
 except ImportError:
-	from .process import Processor
+	from .process import Processor, chunks
+	from .cache import CountCache, Journal, TextStore
 
 # Authors with large numbers of words
 IMPORTANT_AUTHORS = {
@@ -48,10 +53,73 @@ GLOBAL_EXCLUSIONS = {
 }
 JUSTINIAN = ('LAT2806',)
 
+def merge_counters(counters): # Streaming tree reduction: merge pairs of equal "height", like a binary counter, so no one Counter gets added to over and over
+	stack = [] # (height, Counter)
+	for counter in counters:
+		height = 0
+		while stack and stack[-1][0] == height:
+			_, other = stack.pop()
+			other.update(counter) # In place, to save copying
+			counter = other
+			height += 1
+		stack.append((height, counter))
+	if not stack: return Counter()
+	total = stack[0][1] # The biggest one, which everything else gets merged into
+	for _, counter in stack[1:]:
+		total.update(counter)
+	return total
+
+_processor = None # Each worker builds its own Processor once, since the macronizer and syllabifier are expensive to set up
+_corpus = None
+_known = None # The forms this worker's word cache has already reported, if anyone's saving it
+
+def _init_worker(corpus, word_cache=None):
+	global _processor, _corpus, _known
+	_processor = Processor()
+	if word_cache is not None:
+		if Path(word_cache).exists(): _processor.load_word_cache(word_cache)
+		_known = set(_processor.word_cache.data)
+	_corpus = corpus
+	if corpus.texts is not None: corpus.texts.readonly = True # The main process fills in the text store; workers only read it
+
+def _new_words(): # What this worker's word cache has gained since last time, for the main process to save
+	if _known is None: return {}
+	new = {word:value for word, value in _processor.word_cache.data.items() if word not in _known}
+	_known.update(new)
+	return new
+
+def _count_file(fn): # Returns (filename, number of pieces the file was split into, Counter, new word cache entries) for merging in the main process
+	_processor.total_counts = Counter()
+	return fn, 1, _processor.count(_corpus.get_text(fn)), _new_words()
+
+def _init_stats_worker(corpus):
+	global _processor, _corpus
+	_processor = Processor(cache_size=0, light=True)
+	_corpus = corpus
+	if corpus.texts is not None: corpus.texts.readonly = True
+
+def _author_stats(fn):
+	return fn, author_stats(_processor, _corpus.get_text(fn))
+
+def author_stats(proc, text): # (tokens, types after cleaning, tokens after cleaning) for one text
+	words = Counter(text.split())
+	cleaned = Counter()
+	for word, count in words.items(): # Each distinct word only needs cleaning once
+		word = proc.clean(word)
+		if word: cleaned[word] += count
+	return sum(words.values()), len(cleaned), sum(cleaned.values())
+
+def _count_chunk(task): # Likewise, for one piece of a file
+	fn, pieces, text = task
+	_processor.total_counts = Counter()
+	return fn, pieces, _processor.count(text), _new_words()
+
 class PHI5Corpus:
 	
-	def __init__(self):
-		pass
+	def __init__(self, seed=None, text_cache=None):
+		self.random = random.Random(seed) # For `chance` and `shuffle` in get_filenames, so runs can be repeated exactly
+		if text_cache is not None and not isinstance(text_cache, TextStore): text_cache = TextStore(text_cache, self.fingerprint())
+		self.texts = text_cache # A TextStore, or a directory to keep one in, so get_text only cleans each file once
 	
 	def get_filenames(self, limit=None, authorial=True, chance=1.0, exclude=(), include=None, shuffle=False):
 		
@@ -60,7 +128,7 @@ class PHI5Corpus:
 			if stem in GLOBAL_EXCLUSIONS: return False
 			if stem in exclude: return False
 			if include is not None and stem not in include: return False
-			if not (random.random() < chance): return False
+			if not (self.random.random() < chance): return False
 			return True
 		
 		paths = assemble_phi5_author_filepaths() if authorial else assemble_phi5_works_filepaths()
@@ -69,10 +137,18 @@ class PHI5Corpus:
 		if limit is not None: paths = paths[:limit]
 		
 		paths = [Path(fn) for fn in paths if chosen(fn)]
-		if shuffle: random.shuffle(paths)
+		if shuffle: self.random.shuffle(paths)
 		return paths
 	
 	def get_text(self, fn):
+		if self.texts is None: return self.clean_text(fn)
+		text = self.texts.get(fn)
+		if text is None:
+			text = self.clean_text(fn)
+			self.texts.put(fn, text)
+		return text
+	
+	def clean_text(self, fn):
 		with open(fn, 'r') as f:
 			text = f.read()
 		text = phi5_plaintext_cleanup(text)
@@ -80,6 +156,9 @@ class PHI5Corpus:
 		text = re.sub(r'\bdrach(m?)\.', 'drachmae', text) # Deal with a common abbreviation
 		return text
 	
+	def fingerprint(self): # The part of the cache key that comes from here rather than from the Processor
+		return hashlib.sha256(inspect.getsource(PHI5Corpus.clean_text).encode('utf-8')).hexdigest()
+	
 	def get_name(self, fn):
 		name = fn.stem
 		if name not in PHI5_INDEX: raise ValueError(name, fn)
@@ -91,24 +170,24 @@ class PHI5Corpus:
 			print(text)
 			input()
 	
-	def get_author_data(self):
-		data = {}
-		proc = Processor()
-		for fn in tqdm(self.get_filenames(authorial=True)):
-			name = self.get_name(fn)
-			text = self.get_text(fn)
-			words = text.split()
-			id = fn.stem
-			tag = (name, id)
-			
-			data[tag] = 0
-			for word in words: # Count how many words survive proc.clean
-				if proc.clean(word):
-					data[tag] += 1
-		
-		return data
+	def get_author_data(self, workers=None): # How many words of each author survive Processor.clean
+		return {tag:cleaned for tag, (tokens, types, cleaned) in self.get_author_stats(workers).items()}
 	
-	def process_and_save(self, fn, check=False, precomputed=None, overwrite=True, hack_notes=False, **kwargs):
+	def get_author_stats(self, workers=None): # (name, id) to (tokens, types after cleaning, tokens after cleaning), without loading the macronizer
+		paths = self.get_filenames(authorial=True)
+		if workers is not None and workers > 1:
+			if self.texts is not None: # As in count_parallel
+				for fn in paths:
+					if not self.texts.valid(fn.stem, fn): self.texts.put(fn, self.clean_text(fn))
+			paths = sorted(paths, key=lambda p: p.stat().st_size, reverse=True)
+			with mp.Pool(workers, initializer=_init_stats_worker, initargs=(self,)) as pool:
+				results = list(tqdm(pool.imap_unordered(_author_stats, paths), total=len(paths)))
+		else:
+			proc = Processor(cache_size=0, light=True)
+			results = [(fn, author_stats(proc, self.get_text(fn))) for fn in tqdm(paths)]
+		return {(self.get_name(fn), fn.stem):stats for fn, stats in results}
+	
+	def process_and_save(self, fn, check=False, precomputed=None, overwrite=True, hack_notes=False, workers=None, cache=None, word_cache=None, chunk_size=None, journal=None, **kwargs):
 		if fn is not None and Path(fn).exists() and not overwrite:
 			print(f'({fn} already exists, skipping it and moving on)')
 			return
@@ -121,16 +200,37 @@ class PHI5Corpus:
 			proc = Processor()
 		else:
 			proc = precomputed.copy()
+		proc.chunk_size = chunk_size # Macronize a bounded piece at a time (see process.chunks); in parallel, the pieces are what get sent to the workers
+		if word_cache is not None and Path(word_cache).exists(): # A file saved by an earlier run, so we start warm
+			proc.load_word_cache(word_cache)
 		
-		for fn2 in tqdm(self.get_filenames(**kwargs)):
-			text = self.get_text(fn2)
-			prev = sum(proc.total_counts.values())
-			proc.count(text)
-			new = sum(proc.total_counts.values())
-			if hack_notes:
-				with open('hack_notes.csv', 'a') as f:
-					f.write(f'{fn2.stem},{prev},{new},{new-prev}\n')
-			sleep(0.25) # Return control to the system occasionally so things don't crash (just in case)
+		paths = self.get_filenames(**kwargs)
+		if journal is not None: # A Journal, or a file to keep one in; files it already has a record of aren't processed again
+			if not isinstance(journal, Journal): journal = Journal(journal)
+			paths = self.count_journaled(proc, paths, journal, hack_notes)
+		if cache is not None: # A CountCache, or a directory to keep one in; files that have been processed before get their counts from there
+			if not isinstance(cache, CountCache): cache = CountCache(cache)
+			fingerprint = proc.fingerprint() + self.fingerprint()
+			if chunk_size is not None: fingerprint += f'chunk_size={chunk_size}' # Macronizing a piece at a time can tag words differently than doing the whole text at once
+			paths = self.count_cached(proc, paths, cache, fingerprint, hack_notes, journal)
+		
+		if workers is not None and workers > 1:
+			self.count_parallel(proc, paths, workers, hack_notes, cache=None if cache is None else (cache, fingerprint), word_cache=word_cache, chunk_size=chunk_size, journal=journal)
+		else:
+			for fn2 in tqdm(paths):
+				text = self.get_text(fn2)
+				prev = sum(proc.total_counts.values())
+				counts = proc.count(text)
+				new = sum(proc.total_counts.values())
+				if cache is not None: cache.put(fn2, fingerprint, counts)
+				if journal is not None: journal.append(fn2, counts)
+				if hack_notes:
+					with open('hack_notes.csv', 'a') as f:
+						f.write(f'{fn2.stem},{prev},{new},{new-prev}\n')
+				sleep(0.25) # Return control to the system occasionally so things don't crash (just in case)
+		if word_cache is not None:
+			print(proc.word_cache.stats())
+			proc.save_word_cache(word_cache)
 		if check:
 			with open('phi5.full.tsv', 'w') as f:
 				for word, count in proc.total_counts.most_common():
@@ -142,6 +242,80 @@ class PHI5Corpus:
 		if fn is not None:
 			proc.save(fn)
 		return proc # In case it's wanted for later processing
+	
+	def count_journaled(self, proc, paths, journal, hack_notes=False): # Add in the counts of every file the journal has a record of, and return the ones it doesn't
+		done = journal.read()
+		remaining = []
+		for fn2 in paths:
+			counts = done.get(fn2.stem)
+			if counts is None:
+				remaining.append(fn2)
+				continue
+			prev = sum(proc.total_counts.values())
+			proc.total_counts.update(counts)
+			if hack_notes:
+				with open('hack_notes.csv', 'a') as f:
+					f.write(f'{fn2.stem},{prev},{prev+sum(counts.values())},{sum(counts.values())}\n')
+		print(f'({len(paths)-len(remaining)} files from {journal.path}, {len(remaining)} to process)')
+		return remaining
+	
+	def count_cached(self, proc, paths, cache, fingerprint, hack_notes=False, journal=None): # Add in the counts of every file that's in the cache, and return the ones that aren't
+		remaining = []
+		for fn2 in tqdm(paths, leave=False):
+			counts = cache.get(fn2, fingerprint)
+			if counts is None:
+				remaining.append(fn2)
+				continue
+			if journal is not None: journal.append(fn2, counts)
+			prev = sum(proc.total_counts.values())
+			proc.total_counts.update(counts)
+			if hack_notes:
+				with open('hack_notes.csv', 'a') as f:
+					f.write(f'{fn2.stem},{prev},{prev+sum(counts.values())},{sum(counts.values())}\n')
+		print(f'({cache.hits} files from the cache, {len(remaining)} to process)')
+		return remaining
+	
+	def chunk_tasks(self, paths, chunk_size): # (filename, number of pieces, piece) for every piece of every file
+		for fn2 in paths:
+			pieces = list(chunks(self.get_text(fn2), chunk_size)) or [''] # An empty text still needs its (empty) result, to be cached and journaled like any other
+			for piece in pieces:
+				yield fn2, len(pieces), piece
+	
+	def count_parallel(self, proc, paths, workers, hack_notes=False, cache=None, word_cache=None, chunk_size=None, journal=None): # Like the loop in process_and_save, but with a Processor in each of several processes
+		paths = sorted(paths, key=lambda p: p.stat().st_size, reverse=True) # Largest first, so one big author doesn't finish long after everything else
+		if self.texts is not None and chunk_size is None: # Workers can't add to the text store, so fill it in first
+			for fn2 in paths:
+				if not self.texts.valid(fn2.stem, fn2): self.texts.put(fn2, self.clean_text(fn2))
+		prev = sum(proc.total_counts.values())
+		partial = {} # Filename to [Counter, pieces finished], for files that were split up
+		
+		def finished(results): # Put the pieces of each file back together, and pass on each file once it's complete
+			for fn2, pieces, counts, words in results:
+				proc.word_cache.update(words) # (Empty unless word_cache is set)
+				if pieces == 1:
+					yield fn2, counts
+					continue
+				done = partial.setdefault(fn2, [Counter(), 0])
+				done[0].update(counts)
+				done[1] += 1
+				if done[1] == pieces: yield fn2, partial.pop(fn2)[0]
+		
+		def results(pool):
+			nonlocal prev
+			if chunk_size is None: raw = pool.imap_unordered(_count_file, paths)
+			else: raw = pool.imap_unordered(_count_chunk, self.chunk_tasks(paths, chunk_size))
+			for fn2, counts in tqdm(finished(raw), total=len(paths)):
+				if cache is not None: cache[0].put(fn2, cache[1], counts) # (Before merging, which changes the Counters in place)
+				if journal is not None: journal.append(fn2, counts)
+				new = prev + sum(counts.values())
+				if hack_notes: # Files finish in whatever order they finish, so prev and new are running totals in that order
+					with open('hack_notes.csv', 'a') as f:
+						f.write(f'{fn2.stem},{prev},{new},{new-prev}\n')
+				prev = new
+				yield counts
+		
+		with mp.Pool(workers, initializer=_init_worker, initargs=(self, word_cache)) as pool: # Workers start from the saved word cache, and send back what they add to it
+			proc.total_counts.update(merge_counters(results(pool)))
 
 def main_run_complete(): # phi5_new without Justinian, phi5_complete_new with
 	input()
@@ -151,7 +325,7 @@ def main_run_complete(): # phi5_new without Justinian, phi5_complete_new with
 def main_run_probability(): # NO LONGER USED
 	input()
 	for i in trange(10):
-		PHI5Corpus().process_and_save(f'90/{i:02d}.pickle.bz2', chance=0.9)
+		PHI5Corpus(seed=i).process_and_save(f'90/{i:02d}.pickle.bz2', chance=0.9)
 
 def main_run_complete_hack(): # Like main_run_complete but using a checkpoint - NO LONGER USED
 	input()
@@ -166,18 +340,8 @@ def main_run_complete_hack(): # Like main_run_complete but using a checkpoint -
 def main_run_authors(): # NO LONGER USED
 	input()
 	c = PHI5Corpus()
-	# First, do the processing without any important authors
-	pfn = Path('author_checkpoint.pickle.bz2')
-	if pfn.exists():
-		with bz2.open(pfn, 'rb') as f:
-			proc = Processor()
-			proc.total_counts = pickle.load(f)
-		print('(Opened existing checkpoint)')
-	else:
-		proc = c.process_and_save(None, authorial=True, exclude=IMPORTANT_AUTHORS)
-		with bz2.open(pfn, 'wb') as f:
-			pickle.dump(proc.total_counts, f)
-		print('(Checkpoint saved)')
+	# First, do the processing without any important authors (journaled, so a rerun only does the files it hadn't finished)
+	proc = c.process_and_save(None, authorial=True, exclude=IMPORTANT_AUTHORS, journal='author_checkpoint.journal')
 	# Then, go through and process the set of important authors, minus each one individually
 	for auth in tqdm(IMPORTANT_AUTHORS):
 		print(f'Working on {auth}')
@@ -202,22 +366,23 @@ def main_run_authors_redux():
 def compute_solo_author_data():
 	input()
 	path = Path('auth_solo')
-	c = PHI5Corpus()
+	c = PHI5Corpus(text_cache='phi5_texts')
 	# Miscellaneous
-	c.process_and_save(path/f'MISC.pickle.bz2', authorial=True, exclude=IMPORTANT_AUTHORS, overwrite=False, shuffle=True)
+	c.process_and_save(path/f'MISC.pickle.bz2', authorial=True, exclude=IMPORTANT_AUTHORS, overwrite=False, shuffle=True, cache='phi5_cache')
 	# Authors
 	for auth in tqdm(IMPORTANT_AUTHORS):
-		c.process_and_save(path/f'{auth}.pickle.bz2', authorial=True, include=(auth,), overwrite=False, shuffle=True)
+		c.process_and_save(path/f'{auth}.pickle.bz2', authorial=True, include=(auth,), overwrite=False, shuffle=True, cache='phi5_cache')
 
 # Save an overview of different authors' tokens
 def author_data():
 	input()
-	data = PHI5Corpus().get_author_data()
+	stats = PHI5Corpus().get_author_stats(workers=mp.cpu_count())
+	data = {tag:cleaned for tag, (tokens, types, cleaned) in stats.items()} # Same format as before, for plots.latin_author_histogram
 	with bz2.open('authors.pickle.bz2', 'w') as f:
 		pickle.dump(data, f)
-	with open('authors.tsv', 'w') as f:
-		for (name, id), words in sorted(data.items()):
-			f.write(f'{name}\t{id}\t{words}\n')
+	with open('authors.tsv', 'w') as f: # Name, ID, cleaned tokens as before, then raw tokens and cleaned types
+		for (name, id), (tokens, types, cleaned) in sorted(stats.items()):
+			f.write(f'{name}\t{id}\t{cleaned}\t{tokens}\t{types}\n')
 	print('Done')
 
 # Test calculating different authors' types and tokens.
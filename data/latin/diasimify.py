@@ -8,11 +8,20 @@ import re
 from pathlib import Path
 import subprocess as sp
 import random
+import os
+import socket
+import threading
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing as mp
+from array import array
+import json
+import struct
 
 from tqdm import tqdm, trange
 
 from trie import Trie
-from undiasimify import FrenchWord
+from undiasimify import FrenchWord, PHONSEP, SYLLSEP
 
 class Stress(Enum):
 	NONE = ''
@@ -99,10 +108,83 @@ class Lemma: # Represents a Latin word and its frequency
 	def __hash__(self): # IPA is considered the key because that's the only part that survives the round trip through DiaSim so that's what we need to identify it by
 		return hash(self.ipa)
 
+class ReflexRow: # A lazy view of one lemma's reflexes, so `reflexes[ipa][era]` still gives a FrenchWord, built only when asked for
+	def __init__(self, table, row):
+		self.table = table
+		self.row = row
+	
+	def __getitem__(self, era):
+		return FrenchWord.from_compact(self.table.compact_at(self.row, era))
+	
+	def __iter__(self):
+		return iter(self.table.eras)
+	
+	def __len__(self):
+		return len(self.table.eras)
+	
+	def keys(self):
+		return list(self.table.eras)
+	
+	def items(self):
+		return [(era, self[era]) for era in self.table.eras]
+
+class ReflexTable: # Reflexes in columns: one row per lemma (by input IPA), one column per era, and each cell an index into a pool of distinct FrenchWord.compact() forms
+	def __init__(self, eras=()):
+		self.eras = list(eras)
+		self.era_index = {era:i for i, era in enumerate(self.eras)}
+		self.rows = {} # Input IPA to row number
+		self.columns = [array('i') for _ in self.eras]
+		self.pool = [] # Most reflexes are shared between eras (and many between lemmas), so each form is only stored once
+		self.pool_index = {}
+	
+	def intern(self, compact):
+		i = self.pool_index.get(compact)
+		if i is None:
+			i = self.pool_index[compact] = len(self.pool)
+			self.pool.append(compact)
+		return i
+	
+	def add(self, ipa, compacts): # One compact form per era, in order
+		if len(compacts) != len(self.eras): raise ValueError('Wrong number of eras', ipa, len(compacts), len(self.eras))
+		row = self.rows.get(ipa)
+		for column, compact in zip(self.columns, compacts):
+			if row is None: column.append(self.intern(compact))
+			else: column[row] = self.intern(compact) # Replacing an existing lemma, as a dict would
+		if row is None: self.rows[ipa] = len(self.rows)
+	
+	def compact_at(self, row, era):
+		return self.pool[self.columns[self.era_index[era]][row]]
+	
+	def output(self, ipa, era, sep='-', phonsep=''): # Same as self[ipa][era].output(sep, phonsep), without making the FrenchWord
+		return self.compact_at(self.rows[ipa], era).replace(PHONSEP, phonsep).replace(SYLLSEP, sep)
+	
+	def __getitem__(self, ipa):
+		return ReflexRow(self, self.rows[ipa])
+	
+	def __contains__(self, ipa):
+		return ipa in self.rows
+	
+	def __len__(self):
+		return len(self.rows)
+	
+	def __iter__(self):
+		return iter(self.rows)
+	
+	def keys(self):
+		return self.rows.keys()
+
+CORPUS_MAGIC = b'DIACORP1'
+
+def pack_strings(strings): # None of the strings a Corpus stores can contain a newline
+	return '\n'.join(strings).encode('utf-8')
+
+def unpack_strings(data, n): # (n is needed to tell no strings from one empty one)
+	return data.decode('utf-8').split('\n') if n else []
+
 class Corpus:
 	def __init__(self, counts=None):
 		self.data = {}
-		self.reflexes = {}
+		self.reflexes = ReflexTable()
 		warnings = []
 		self.ids = {}
 		
@@ -121,17 +203,80 @@ class Corpus:
 			f.write('\n'.join(warnings))
 	
 	@classmethod
-	def from_file(cls, fn):
+	def from_file(cls, fn): # A file from save_file, a pickled Corpus from before that existed, or a pickled Counter
+		with open(fn, 'rb') as f:
+			if f.read(len(CORPUS_MAGIC)) == CORPUS_MAGIC:
+				return cls.from_bytes(CORPUS_MAGIC + f.read())
 		opener = bz2.open if str(fn).endswith('bz2') else open
 		with opener(fn, 'rb') as f:
 			d = pickle.load(f)
-		if isinstance(d, Corpus): return d
+		if isinstance(d, Corpus):
+			if isinstance(d.reflexes, dict): # Old format, with a dict of FrenchWords for each lemma
+				old, d.reflexes = d.reflexes, ReflexTable(getattr(d, 'eras', ()))
+				for ipa, words in old.items():
+					d.reflexes.add(ipa, [words[era].compact() for era in d.reflexes.eras])
+			return d
 		return cls(d)
 	
-	def save_file(self, fn):
-		opener = bz2.open if str(fn).endswith('bz2') else open
-		with opener(fn, 'wb') as f:
-			pickle.dump(self, f)
+	def save_file(self, fn): # Binary format (see to_bytes), much faster to load than pickled FrenchWords
+		with open(fn, 'wb') as f:
+			f.write(self.to_bytes())
+	
+	def to_bytes(self): # Magic, header length, JSON header, then each section (strings joined by newlines, or raw arrays) one after another
+		lemmas = list(self.data.values())
+		rows = list(self.reflexes.rows)
+		sections = {
+			'lemma_ipa': pack_strings(l.ipa for l in lemmas),
+			'lemma_latin': pack_strings(l.latin for l in lemmas),
+			'lemma_wide': pack_strings(l.ipa_wide for l in lemmas),
+			'lemma_count': array('q', [l.count for l in lemmas]).tobytes(),
+			'reflex_ipa': pack_strings(rows),
+			'reflex_id': pack_strings(self.ids.get(ipa, '') for ipa in rows),
+			'pool': pack_strings(self.reflexes.pool),
+		}
+		for i, column in enumerate(self.reflexes.columns):
+			sections[f'column{i}'] = column.tobytes()
+		header = {'eras':self.reflexes.eras, 'lemmas':len(lemmas), 'rows':len(rows), 'pool':len(self.reflexes.pool), 'sections':{}}
+		offset = 0
+		for name, data in sections.items():
+			header['sections'][name] = (offset, len(data))
+			offset += len(data)
+		header = json.dumps(header).encode('utf-8')
+		return b''.join([CORPUS_MAGIC, struct.pack('<Q', len(header)), header] + list(sections.values()))
+	
+	@classmethod
+	def from_bytes(cls, buf):
+		buf = memoryview(buf)
+		start = len(CORPUS_MAGIC) + 8
+		size, = struct.unpack('<Q', buf[len(CORPUS_MAGIC):start])
+		header = json.loads(bytes(buf[start:start+size]).decode('utf-8'))
+		start += size
+		def section(name):
+			offset, length = header['sections'][name]
+			return bytes(buf[start+offset:start+offset+length])
+		def numbers(name, typecode):
+			a = array(typecode)
+			a.frombytes(section(name))
+			return a
+		
+		new = cls()
+		counts = numbers('lemma_count', 'q')
+		n = header['lemmas']
+		for ipa, latin, wide, count in zip(unpack_strings(section('lemma_ipa'), n), unpack_strings(section('lemma_latin'), n), unpack_strings(section('lemma_wide'), n), counts):
+			lemma = Lemma.__new__(Lemma) # Without redoing the IPA conversion
+			lemma.latin, lemma.count, lemma.ipa_wide, lemma.ipa = latin, count, wide, ipa
+			new.data[ipa] = lemma
+		
+		table = ReflexTable(header['eras'])
+		table.pool = unpack_strings(section('pool'), header['pool'])
+		table.pool_index = {compact:i for i, compact in enumerate(table.pool)}
+		rows = unpack_strings(section('reflex_ipa'), header['rows'])
+		table.rows = {ipa:i for i, ipa in enumerate(rows)}
+		table.columns = [numbers(f'column{i}', 'i') for i in range(len(table.eras))]
+		new.reflexes = table
+		new.ids = {ipa:id for ipa, id in zip(rows, unpack_strings(section('reflex_id'), header['rows'])) if id}
+		if table.eras: new.eras = list(table.eras)
+		return new
 	
 	def save_lexes(self, fn, chunksize=10000):
 		fn = Path(fn) # In case a string was passed
@@ -143,83 +288,212 @@ class Corpus:
 				for lemma in chunk:
 					f.write(f'{lemma.ipa_wide} $ {lemma.latin}\n')
 	
-	def add_reflexes(self, fn): # Wrapper that can take a directory instead of a file for convenience
+	def add_reflexes(self, fn, workers=None): # Wrapper that can take a directory instead of a file for convenience; with workers, files are read in that many processes
 		fn = Path(fn)
-		if fn.is_dir():
-			for child in tqdm(list(fn.glob('**/*_output_graph.csv'))):
-				self.add_reflexes_single(child)
+		files = sorted(fn.glob('**/*_output_graph.csv')) if fn.is_dir() else [fn]
+		if workers is not None and workers > 1 and len(files) > 1:
+			with mp.Pool(workers) as pool:
+				for result in tqdm(pool.imap(read_reflexes, files), total=len(files)): # In order, so the result doesn't depend on timing, but still merged as each file arrives
+					self.merge_reflexes(*result)
 		else:
-			self.add_reflexes_single(fn)
+			for child in tqdm(files, disable=len(files) == 1):
+				self.merge_reflexes(*read_reflexes(child))
 	
 	def add_reflexes_single(self, fn):
-		fn = Path(fn)
-		with open(fn, 'r', newline='') as f:
-			reader = csv.reader(f, delimiter='|')
-			firstline = next(reader)
-			headers = [x.strip() for x in firstline]
-			eras = headers[1:] + ['Classical No Stress', 'Classical KW No Stress']
-			if hasattr(self, 'eras') and self.eras != eras: raise ValueError('Mismatched eras', self.eras, eras, fn)
-			self.eras = eras
-			
-			for line in tqdm(reader, total=10000, disable=True): # Set to default chunk size for now
-				fields = [x.strip(' #') for x in line]
-				fields[0] = int(fields[0]) # ID number
-				ipa = fields[1]
-				self.ids[ipa] = fn.parent.name+'_'+str(fields[0])
-				# Copy in the reflex from each era
-				self.reflexes[ipa] = {h:FrenchWord(f) for h,f in zip(headers[1:], fields[1:])}
-				# Then put in two special ones
-				self.reflexes[ipa]['Classical No Stress'] = FrenchWord(ipa, stress=False)
-				self.reflexes[ipa]['Classical KW No Stress'] = FrenchWord(ipa, stress=False, kw_correction=True)
+		self.merge_reflexes(*read_reflexes(fn))
+	
+	def merge_reflexes(self, fn, eras, rows): # Takes the output of read_reflexes
+		if hasattr(self, 'eras') and self.eras != eras: raise ValueError('Mismatched eras', self.eras, eras, fn)
+		self.eras = eras
+		if not self.reflexes.eras: self.reflexes = ReflexTable(eras)
+		for id, ipa, compacts in rows:
+			self.ids[ipa] = id
+			self.reflexes.add(ipa, compacts)
 	
 	def output_corpora(self, fn):
 		fn = Path(fn) # In case a string was passed
 		fn.mkdir(parents=True, exist_ok=True) # This is the directory we'll put our output data in
 		for era in tqdm(self.eras):
-			dout = { self.reflexes[id][era].output(sep='-') : self.data[id] for id in self.data } # reflex : count
+			dout = { self.reflexes.output(id, era, sep='-') : self.data[id] for id in self.data } # reflex : count
 			with bz2.open(fn / (era + '.pickle.bz2'), 'wb') as f:
 				pickle.dump(dout, f)
 	
+	def output_table(self, fn): # Every era in one file, all lined up with one list of counts, for analyze.MultiEraAnalysis
+		ids = list(self.data)
+		table = {
+			'eras': list(self.eras),
+			'counts': [self.data[id].count for id in ids],
+			'forms': {era:[self.reflexes.output(id, era, sep='-') for id in ids] for era in self.eras}, # Lemmas whose reflexes coincide stay separate, each with its own count
+		}
+		with bz2.open(fn, 'wb') as f:
+			pickle.dump(table, f)
+	
 	def output_csv(self, fn):
 		headings = ['ID'] + self.eras
 		with open(fn, 'w', newline='') as f:
 			write = csv.writer(f)
 			write.writerow(headings)
 			for id in tqdm(self.data):
-				row = [self.ids[id]] + [self.reflexes[id][era].output() for era in self.eras]
+				row = [self.ids[id]] + [self.reflexes.output(id, era) for era in self.eras]
 				write.writerow(row)
 
+def read_reflexes(fn): # One DiaSim output file, as (filename, eras, [(ID, input IPA, [FrenchWord.compact() for each era])]); top-level so a process pool can run it
+	fn = Path(fn)
+	rows = []
+	with open(fn, 'r', newline='') as f:
+		reader = csv.reader(f, delimiter='|')
+		firstline = next(reader)
+		headers = [x.strip() for x in firstline]
+		eras = headers[1:] + ['Classical No Stress', 'Classical KW No Stress']
+		
+		for line in reader:
+			fields = [x.strip(' #') for x in line]
+			fields[0] = int(fields[0]) # ID number
+			ipa = fields[1]
+			# The reflex from each era, then two special ones
+			if len(fields) < len(headers): raise ValueError('Missing eras', fn, line)
+			words = [FrenchWord(f) for f in fields[1:len(headers)]]
+			words.append(FrenchWord(ipa, stress=False))
+			words.append(FrenchWord(ipa, stress=False, kw_correction=True))
+			rows.append((fn.parent.name+'_'+str(fields[0]), ipa, [w.compact() for w in words]))
+	return str(fn), eras, rows
+
 def filelen(fn): # Let's see if this can work with tqdm
 	with open(fn, 'r') as f:
 		return len(f)
 
 DIASIMDIR = (Path(__file__) / '..' / '..' / '..' / 'DiaSim').resolve()
 DIACLEF = Path('./DiaCLEF_Black').resolve()
-def run_diasim_on(lexfn, outdir, cwd=DIASIMDIR, clef=DIACLEF, replace=False):
+FAKE_DERIVE = Path(__file__).parent / 'fake_derive.py' # Stands in for DiaSim's derive.sh, for testing run_diasim without DiaSim
+
+def run_diasim_on(lexfn, outdir, cwd=None, clef=DIACLEF, replace=False, derive=None): # Returns DiaSim's exit code, or None if this chunk was already done
 	lexfn = Path(lexfn).resolve()
 	outdir = Path(outdir).resolve()
 	outfn = outdir / lexfn.stem
-	process = cwd / 'derive.sh'
+	if cwd is None: cwd = DIASIMDIR if derive is None else Path(derive).resolve().parent
+	process = Path(cwd) / 'derive.sh' if derive is None else Path(derive).resolve()
 #	print(lexfn, outdir, outfn, cwd)
 	if (outfn / 'derivation').exists() and not replace: # This file isn't filled in until the end so we can confirm it ran fully and wasn't interrupted
 		print(f'(Skipped existing {lexfn.stem})')
-		return
+		return None
 	print(f'Working on {lexfn.stem}...')
 	outfn.mkdir(parents=True, exist_ok=True) # So that we can stick stdout and stderr files in there
 	with open(outfn/'out.log', 'w') as outf:
 		with open(outfn/'err.log', 'w') as errf:
-			sp.run([process, '-lex', lexfn, '-rules', clef, '-out', outfn], cwd=cwd, stdout=outf, stderr=errf)
+			return sp.run([process, '-lex', lexfn, '-rules', clef, '-out', outfn], cwd=cwd, stdout=outf, stderr=errf).returncode
+
+def claim(outdir, stem, stale=None): # Atomically mark a chunk as taken, so several processes (or hosts sharing outdir) never run the same one; False if someone else has it
+	fn = Path(outdir) / f'{stem}.claim'
+	if stale is not None and fn.exists() and time() - fn.stat().st_mtime > stale: # Whoever claimed it has presumably died
+		moved = fn.with_name(f'{fn.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}')
+		try:
+			os.rename(fn, moved) # Only one taker can move it out of the way
+		except FileNotFoundError:
+			return False # Someone else took it over first
+		if time() - moved.stat().st_mtime <= stale: # What got moved was a fresh claim made in the meantime, so put it back
+			try:
+				os.link(moved, fn)
+			except FileExistsError:
+				pass
+			moved.unlink()
+			return False
+		print(f'(Taking over stale claim on {stem})')
+		moved.unlink()
+	try:
+		fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except FileExistsError:
+		return False
+	with os.fdopen(fd, 'w') as f:
+		f.write(f'{socket.gethostname()}\t{os.getpid()}\t{time()}\n')
+	return True
+
+def heartbeat(fn, interval, done): # Keep touching a claim until done is set, so it never looks stale while its chunk is running
+	while not done.wait(interval):
+		try:
+			os.utime(fn)
+		except FileNotFoundError:
+			return
 
-def run_diasim(lexdir, outdir, cwd=DIASIMDIR, replace=False, shuffle=True):
+def err_tail(outfn, lines=5): # The end of a chunk's err.log, for reporting failures
+	fn = Path(outfn) / 'err.log'
+	if not fn.exists(): return ''
+	with open(fn, 'r', errors='replace') as f:
+		return ''.join(f.readlines()[-lines:]).strip()
+
+def run_chunk(lexfn, outdir, cwd=None, clef=DIACLEF, replace=False, derive=None, retries=1, stale=600): # One chunk, claimed and retried; returns a dict describing what happened
+	lexfn = Path(lexfn)
+	outfn = Path(outdir).resolve() / lexfn.stem
+	claimfn = Path(outdir) / f'{lexfn.stem}.claim'
+	result = {'chunk':lexfn.stem, 'status':'done', 'attempts':0, 'seconds':0.0, 'error':''}
+	if (outfn / 'derivation').exists() and not replace:
+		result['status'] = 'skipped'
+		return result
+	if not claim(outdir, lexfn.stem, stale):
+		result['status'] = 'claimed' # By another process
+		return result
+	if (outfn / 'derivation').exists() and not replace: # Another host finished it between the check and the claim
+		claimfn.unlink(missing_ok=True)
+		result['status'] = 'skipped'
+		return result
+	done = threading.Event()
+	if stale is not None:
+		threading.Thread(target=heartbeat, args=(claimfn, stale / 3, done), daemon=True).start()
+	try:
+		for attempt in range(retries + 1):
+			result['attempts'] = attempt + 1
+			start = perf_counter()
+			try:
+				code = run_diasim_on(lexfn, outdir, cwd=cwd, clef=clef, replace=True, derive=derive) # (Anything half-finished from before gets overwritten)
+			except OSError as e: # Couldn't even start it
+				code = e
+			result['seconds'] += perf_counter() - start # Every attempt counts towards the chunk's time
+			if code == 0 and (outfn / 'derivation').exists():
+				result['error'] = '' # Earlier attempts' errors don't matter any more
+				break
+			if isinstance(code, int) and code < 0: # Killed by a signal (Ctrl-C, say), which retrying won't fix
+				result['error'] = f'killed by signal {-code}'
+				result['status'] = 'failed'
+				break
+			result['error'] = f'{code!r}' if isinstance(code, OSError) else f'exit code {code}: ' + err_tail(outfn)
+		else:
+			result['status'] = 'failed'
+	finally:
+		done.set()
+		claimfn.unlink(missing_ok=True) # Finished or failed for good, so the claim can go (the derivation file marks it done)
+	return result
+
+def run_diasim(lexdir, outdir, cwd=None, replace=False, shuffle=True, workers=1, retries=1, derive=None, stale=600, clef=DIACLEF):
+	# Runs up to `workers` chunks at once; other copies of this (on this host or others sharing outdir) can run at the same time, since each chunk gets claimed first
+	# `stale` is how many seconds old a claim has to be before it's assumed abandoned (running chunks keep theirs fresh, so this only has to outlast a missed heartbeat or two; None means claims never expire); `derive` replaces derive.sh (see FAKE_DERIVE)
 	lexdir = Path(lexdir)
-	targets = list(lexdir.iterdir())
-	if shuffle: random.shuffle(targets) # Means if we run this script multiple times at once we can do calculations in parallel
-	for lexfn in tqdm(targets):
-		run_diasim_on(lexfn, outdir, cwd=cwd, replace=replace)
+	outdir = Path(outdir)
+	outdir.mkdir(parents=True, exist_ok=True)
+	targets = sorted(lexdir.glob('*.lex'))
+	if shuffle: random.shuffle(targets) # So copies started at the same time don't all contend for the same claims first
+	results = []
+	with ThreadPoolExecutor(max_workers=workers) as pool: # Threads are enough, since the work happens in the subprocesses
+		futures = [pool.submit(run_chunk, lexfn, outdir, cwd, clef, replace, derive, retries, stale) for lexfn in targets]
+		try:
+			for future in tqdm(as_completed(futures), total=len(futures)):
+				result = future.result()
+				results.append(result)
+				if result['status'] in ('done', 'failed'):
+					with open(outdir / 'timings.tsv', 'a') as f: # One line per chunk run, from every host
+						f.write(f'{result["chunk"]}\t{socket.gethostname()}\t{result["status"]}\t{result["attempts"]}\t{result["seconds"]:.1f}\n')
+		except BaseException: # Ctrl-C, say: don't start any of the chunks still waiting (the ones already running finish, or die with the same signal)
+			pool.shutdown(wait=False, cancel_futures=True)
+			raise
+	
+	failed = [r for r in results if r['status'] == 'failed']
+	counts = {status:sum(r['status'] == status for r in results) for status in ('done', 'skipped', 'claimed', 'failed')}
+	print(', '.join(f'{n} {status}' for status, n in counts.items()))
+	for r in failed:
+		print(f'{r["chunk"]} failed after {r["attempts"]} attempts: {r["error"]}')
+	return results
 
 if __name__ == '__main__':
 	input()
-#	c = Corpus.from_file('phi5_diachronic.pickle.bz2')
+#	c = Corpus.from_file('phi5_diachronic.dcorp')
 	c = Corpus.from_file('phi5.pickle.bz2')
 	print('Corpus loaded')
 #	c.save_lexes('phi5_lex') # directory
@@ -230,7 +504,9 @@ if __name__ == '__main__':
 	print('Reflexes loaded')
 #	c.output_corpora('phi5_diachronic')
 #	print('Individual corpora output')
-	c.save_file('phi5_diachronic.pickle.bz2')
+#	c.output_table('phi5_diachronic_table.pickle.bz2')
+#	print('Table output')
+	c.save_file('phi5_diachronic.dcorp')
 	print('Complete corpus output')
 #	c.output_csv('phi5_diachronic.csv')
 #	print('CSV output')
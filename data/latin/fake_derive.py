@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Stand-in for DiaSim's derive.sh, taking the same arguments, for testing diasimify.run_diasim without DiaSim
+# Every era's reflex is just the input, so the output can be read back in with Corpus.add_reflexes
+# FAKE_DIASIM_FAIL (a probability) makes some runs fail, and FAKE_DIASIM_SLEEP (seconds) makes every run slower
+
+import sys
+import os
+import random
+from time import sleep
+from pathlib import Path
+
+ERAS = ['Input', 'Late Latin', 'Old French', 'Modern French']
+
+def main(args):
+	opts = dict(zip(args[::2], args[1::2]))
+	lexfn, outdir = Path(opts['-lex']), Path(opts['-out'])
+	sleep(float(os.environ.get('FAKE_DIASIM_SLEEP', 0)))
+	if random.random() < float(os.environ.get('FAKE_DIASIM_FAIL', 0)):
+		print(f'Simulated failure on {lexfn.name}', file=sys.stderr)
+		return 1
+	
+	with open(lexfn, 'r') as f:
+		ipas = [line.split('$')[0].replace(' ', '') for line in f if line.strip()]
+	with open(outdir / f'{lexfn.stem}_output_graph.csv', 'w') as f:
+		f.write(' | '.join(['ID'] + ERAS) + '\n')
+		for i, ipa in enumerate(ipas):
+			f.write(' | '.join([str(i)] + [ipa] * len(ERAS)) + '\n')
+	(outdir / 'derivation').mkdir(exist_ok=True) # Last, as in DiaSim, since this marks the run as complete
+	print(f'Derived {len(ipas)} etyma')
+	return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv[1:]))
@@ -59,7 +59,7 @@ class Frenchifier:
 			return self.convert_text_multi(f.read())
 
 if __name__ == '__main__':
-	f = Frenchifier(Corpus.from_file('phi5_diachronic.pickle.bz2'))
+	f = Frenchifier(Corpus.from_file('phi5_diachronic.dcorp'))
 	print('Ready')
 	data = f.convert_file_multi('demo_latin.txt')
 	print('Converted')
@@ -1,7 +1,10 @@
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
 import bz2
 import pickle
+import hashlib
+import inspect
+from functools import partial
 
 from cltk.prosody.latin.syllabifier import Syllabifier
 from cltk.prosody.latin.scansion_constants import ScansionConstants
@@ -12,6 +15,7 @@ from pathlib import Path
 # Change the following line to point to wherever Alatius's macronizer is installed
 sys.path.insert(1, str(Path(__file__).parent/'latin-macronizer'))
 from macronizer import Macronizer
+import macronizer
 
 from tqdm import tqdm # Progress bars are nice
 
@@ -23,9 +27,74 @@ EXTRA_CONSONANTS = KW + GW
 
 VALID = 'abcdefghijklmnopqrstuvwxyzāēīōūȳ' + EXTRA_CONSONANTS
 
+SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+')
+WHITESPACE = re.compile(r'\s+')
+
+def chunks(text, size=100_000): # Split text into pieces of roughly `size` characters, at sentence boundaries where possible, so the macronizer never sees a whole author at once
+	start = 0
+	while len(text) - start > size:
+		end = SENTENCE_END.search(text, start + size)
+		if end is None or end.start() - start > 2 * size: # No sentence boundary anywhere nearby, so settle for a word boundary
+			end = WHITESPACE.search(text, start + size)
+			if end is None: break
+		yield text[start:end.start()]
+		start = end.end()
+	if start < len(text): yield text[start:]
+
+DELABIALIZE = {KW:'cu', GW:'gu'} # kʷ → k / _ u, gʷ → g / _ u
+CS = str.maketrans({'x':'cs', 'k':'c'}) # represent sequence ks as cs; c and k both represent voiceless velar stop
+
+def stable_repr(value): # Like repr, but sets and dicts come out the same no matter the hash seed
+	if isinstance(value, (set, frozenset)):
+		return '{' + ', '.join(sorted(stable_repr(v) for v in value)) + '}'
+	if isinstance(value, dict):
+		return '{' + ', '.join(sorted(f'{stable_repr(k)}: {stable_repr(v)}' for k, v in value.items())) + '}'
+	if isinstance(value, (list, tuple)):
+		return '[' + ', '.join(stable_repr(v) for v in value) + ']'
+	return repr(value)
+
+class WordCache: # Bounded LRU memo: Latin is Zipfian, so most tokens are a few thousand forms we've already seen
+	
+	def __init__(self, maxsize=200_000):
+		self.maxsize = maxsize
+		self.data = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key, compute):
+		if key in self.data:
+			self.hits += 1
+			self.data.move_to_end(key)
+			return self.data[key]
+		self.misses += 1
+		value = compute(key)
+		if self.maxsize:
+			self.data[key] = value
+			if len(self.data) > self.maxsize: self.data.popitem(last=False) # Least recently used
+		return value
+	
+	def stats(self):
+		total = self.hits + self.misses
+		return f'{len(self.data)} forms cached, {self.hits} hits, {self.misses} misses ({self.hits / total if total else 0:.1%} hit rate)'
+	
+	def save(self, fn, fingerprint): # The fingerprint makes sure we never load results from different processing settings
+		with bz2.open(fn, 'wb') as f:
+			pickle.dump((fingerprint, dict(self.data)), f)
+	
+	def load(self, fn, fingerprint): # Returns whether anything was loaded
+		with bz2.open(fn, 'rb') as f:
+			saved, data = pickle.load(f)
+		if saved != fingerprint: return False
+		self.update(data)
+		return True
+	
+	def update(self, entries): # Add results worked out elsewhere (in another process, say)
+		self.data.update(entries)
+		while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
 class Processor:
 	
-	def __init__(self):
+	def __init__(self, cache_size=200_000, chunk_size=None, light=False): # cache_size=0 turns off the word cache; see chunks() for chunk_size; light=True is only good for clean(), but doesn't load the macronizer
 		self.constants = ScansionConstants()
 		self.constants.CONSONANTS += EXTRA_CONSONANTS
 		self.constants.CONSONANTS_WO_H += EXTRA_CONSONANTS
@@ -42,20 +111,71 @@ class Processor:
 		for pref in ('se','di'):
 			self.constants.PREFIXES.remove(pref)
 		
-		self.macronizer = Macronizer()
-		self.syllabifier = Syllabifier(self.constants, convert_i_to_j=False)
+		self.compile_cleaner() # (After the prefix list is finalized, since the regexes use it)
+		
+		if not light:
+			self.macronizer = Macronizer()
+			self.syllabifier = Syllabifier(self.constants, convert_i_to_j=False)
 		
 		self.total_counts = Counter()
+		self.word_cache = WordCache(cache_size)
+		self.chunk_size = chunk_size # If set, texts get macronized a chunk at a time, so memory use doesn't depend on the length of the text
 	
 	def copy(self):
-		new = Processor()
+		new = Processor(chunk_size=self.chunk_size)
 		new.total_counts = self.total_counts.copy()
+		new.word_cache = self.word_cache # Safe to share, since the results only depend on the word
 		return new
 	
+	def fingerprint(self): # Changes whenever anything that affects the output of process() changes, for caching
+		h = hashlib.sha256()
+		for name in sorted(vars(self.constants)): # Prefix lists, diphthongs, exceptions, consonant classes...
+			h.update(f'{name}={stable_repr(getattr(self.constants, name))};'.encode('utf-8'))
+		for method in (Processor.macronize, Processor.compile_cleaner, Processor.clean, Processor.syllabify, Processor.process_word, Processor.process):
+			h.update(inspect.getsource(method).encode('utf-8'))
+		h.update(repr((BOUNDARY, KW, GW, VALID)).encode('utf-8'))
+		with open(macronizer.__file__, 'rb') as f: # The macronizer has no version number, so use its code instead
+			h.update(f.read())
+		return h.hexdigest()
+	
 	def macronize(self, text):
 		return self.macronizer.macronize(text, domacronize=True, alsomaius=False, performutov=True, performitoj=True, markambigs=False)
 	
-	def clean(self, word):
+	def compile_cleaner(self): # Everything clean() needs, built once rather than for every word
+		voiceless = f'([ptcqsf{KW}])'
+		vowel = '([aeiouyāēīōūȳ])'
+		consonant = '([^aeiouyāēīōūȳ])'
+		prefix = '(ambi|ante|co|contra|contrā|de|dē|di|dī|ē|ex|extra|extrā|extro|infra|īnfrā|intro|intrō|iuxta|juxtā|ne|nē|prae|pre|pro|prō|quasi|re|rē|retro|retrō|se|sē|sine|supra|suprā|tra|trā|ultra|ultrā)' # See clean_reference
+		full_prefix = '(' + '|'.join(self.constants.PREFIXES) + '|e|ē)'
+		
+		self.invalid = re.compile('[^'+VALID+']')
+		self.vowel = re.compile(vowel)
+		# Each rule is (triggers, function): it only runs if one of the triggers is in the word, since most rules don't apply to most words
+		# The order is the same as in clean_reference, and the only rules merged into one pass are ones that can't feed or bleed each other
+		self.clean_rules = [
+			(('ic',), partial(re.compile(f'{full_prefix}ic(i|ī|ere)').sub, r'\1jic\2')),
+			(('b',), partial(re.compile(f'b{voiceless}').sub, r'p\1')),
+			(('d',), partial(re.compile(f'd{voiceless}').sub, r't\1')),
+			(('q',), partial(re.compile('q[uv]').sub, KW)),
+			(('ng',), partial(re.compile(f'ng[uv]{vowel}').sub, fr'n{GW}\1')),
+			((KW, GW), partial(re.compile(f'([{KW}{GW}])u').sub, lambda m: DELABIALIZE[m.group(1)])),
+			(('av',), partial(re.compile(f'av{consonant}').sub, r'au\1')),
+			(('x', 'k'), lambda word: word.translate(CS)),
+			(('j',), partial(re.compile(f'{vowel}j{vowel}').sub, r'\1jj\2')),
+			(('jj',), partial(re.compile(f'{prefix}jj').sub, r'\1j')),
+			(('z',), partial(re.compile(f'{vowel}z{vowel}').sub, r'\1zz\2')),
+		]
+	
+	def clean(self, word): # Same output as clean_reference (see golden_test), but precompiled
+		word = self.invalid.sub('', word.lower()).strip()
+		if not word: return None
+		if not self.vowel.search(word): return None
+		for triggers, rule in self.clean_rules:
+			if any(t in word for t in triggers):
+				word = rule(word)
+		return word
+	
+	def clean_reference(self, word): # The original version of clean(), kept to check the fast one against
 		voiceless = f'([ptcqsf{KW}])'
 		vowel = '([aeiouyāēīōūȳ])'
 		consonant = '([^aeiouyāēīōūȳ])'
@@ -94,14 +214,26 @@ class Processor:
 	def syllabify(self, word):
 		return self.syllabifier.syllabify(word)
 	
+	def process_word(self, word): # One macronized word to its syllabified form, or None if it's not a word
+		word = self.clean(word)
+		if not word: return None
+		syls = self.syllabify(word)
+		return BOUNDARY.join(syls)
+	
 	def process(self, text):
-		text = self.macronize(text)
-		words = text.split()
-		for word in words:
-			word = self.clean(word)
-			if not word: continue
-			syls = self.syllabify(word)
-			yield BOUNDARY.join(syls)
+		for piece in ([text] if self.chunk_size is None else chunks(text, self.chunk_size)):
+			piece = self.macronize(piece)
+			words = piece.split()
+			for word in words:
+				word = self.word_cache.get(word, self.process_word) # Keyed on the macronized form, since that's all clean and syllabify see
+				if not word: continue
+				yield word
+	
+	def save_word_cache(self, fn): # So later corpus builds can start warm
+		self.word_cache.save(fn, self.fingerprint())
+	
+	def load_word_cache(self, fn):
+		return self.word_cache.load(fn, self.fingerprint())
 	
 	def count(self, text): # Process a text and count its words
 		data = Counter()
@@ -109,6 +241,7 @@ class Processor:
 			if not word: continue
 			data[word] += 1
 		self.total_counts += data
+		return data # Just this text's counts, for caching
 	
 	def save(self, fn): # Save counts to a file
 		opener = bz2.open if str(fn).endswith('bz2') else open # Make sure we open the file the right way
@@ -116,6 +249,21 @@ class Processor:
 		with opener(fn, 'wb') as f:
 			pickle.dump(d, f)
 
+def golden_test(limit=50, words=20_000): # Check clean() against clean_reference() on words from the first `limit` PHI5 authors
+	try: # (Imported here because corpus imports this module)
+		from corpus import PHI5Corpus
+	except ImportError:
+		from .corpus import PHI5Corpus
+	c = PHI5Corpus()
+	p = Processor(cache_size=0)
+	checked = 0
+	for fn in tqdm(c.get_filenames(limit=limit)):
+		for word in p.macronize(' '.join(c.get_text(fn).split()[:words])).split():
+			a, b = p.clean(word), p.clean_reference(word)
+			if a != b: raise ValueError('Mismatch', fn, word, a, b)
+			checked += 1
+	print(f'{checked} words OK')
+
 if __name__ == '__main__':
 	p = Processor()
 	while True:
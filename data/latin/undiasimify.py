@@ -25,6 +25,10 @@ VELAR = r'[kɡg]'
 SYLLABIC = r'[\u0329\u030d]'
 NONSYLLABIC = r'\u032f'
 
+# Separators for FrenchWord.compact: neither can appear in IPA
+PHONSEP = '\x1f'
+SYLLSEP = '\x1e'
+
 def has(phon, pattern):
 	return bool(re.search(pattern, phon))
 
@@ -39,6 +43,19 @@ def is_waw(phon):
 def is_velar(phon):
 	return has(phon, VELAR)
 
+# Everything syllabify needs to know about a phoneme, as bits, so each distinct phoneme only goes through the regexes above once
+VOWEL_BIT, LIQUID_BIT, STOP_BIT, WAW_BIT, VELAR_BIT = 1, 2, 4, 8, 16
+
+class FeatureTable(dict): # Phoneme to bitmask, filled in the first time each phoneme is seen
+	def __missing__(self, phon):
+		mask = (VOWEL_BIT * is_vowel(phon)) | (LIQUID_BIT * is_liquid(phon)) | (STOP_BIT * is_stop(phon)) | (WAW_BIT * is_waw(phon)) | (VELAR_BIT * is_velar(phon))
+		self[phon] = mask
+		return mask
+
+FEATURES = FeatureTable()
+PHONEME_RE = re.compile(PHONEME)
+STRESS_RE = re.compile(STRESS)
+
 class FrenchWord:
 	def __init__(self, ipa, kw_correction=False, stress=True):
 		self.ipa = ipa
@@ -46,8 +63,8 @@ class FrenchWord:
 		self.syllabify(kw_correction)
 	
 	def phonemify(self, stress=True): # Split continuous IPA into a list of phonemes (i.e. characters with diacritics attached)
-		ipa = self.ipa if stress else re.sub(STRESS, '', self.ipa)
-		self.phonemes = re.findall(PHONEME, ipa)
+		ipa = self.ipa if stress else STRESS_RE.sub('', self.ipa)
+		self.phonemes = PHONEME_RE.findall(ipa)
 		if sum(len(p) for p in self.phonemes) != len(ipa):
 			raise ValueError('Something got lost', ipa, ' '.join(self.phonemes))
 	#	print(self.phonemes)
@@ -58,7 +75,7 @@ class FrenchWord:
 		
 		for phon in self.phonemes:
 			# First, give each vowel its own syllable, and put everything in the coda
-			if is_vowel(phon):
+			if FEATURES[phon] & VOWEL_BIT:
 				if initial: # (Exception: everything before the *first* vowel must be in the onset, so the first vowel does *not* make a new syllable)
 					self.syllables[-1].append(phon)
 					initial = False
@@ -67,12 +84,12 @@ class FrenchWord:
 				# But if it's not the first vowel we've seen, make a new syllable!
 				newsyll = [phon]
 				# Now, check if there's a consonant right before this. If so, stick it into the onset.
-				if not is_vowel(self.syllables[-1][-1]):
+				if not FEATURES[self.syllables[-1][-1]] & VOWEL_BIT:
 					newsyll.insert(0, self.syllables[-1].pop()) # Remove it from the previous syllable and insert it at the start of this one
 					# Now check for the special case of stop + liquid which is the only cluster we're allowing in onsets (I think?)
-					if is_liquid(newsyll[0]) and is_stop(self.syllables[-1][-1]):
+					if FEATURES[newsyll[0]] & LIQUID_BIT and FEATURES[self.syllables[-1][-1]] & STOP_BIT:
 						newsyll.insert(0, self.syllables[-1].pop()) # Repeat the popping!
-					elif kw_correction and is_waw(newsyll[0]) and is_velar(self.syllables[-1][-1]): # If we set the kw_correction flag, we also want kw and gw to remain together instead of being split across syllable boundaries
+					elif kw_correction and FEATURES[newsyll[0]] & WAW_BIT and FEATURES[self.syllables[-1][-1]] & VELAR_BIT: # If we set the kw_correction flag, we also want kw and gw to remain together instead of being split across syllable boundaries
 						newsyll.insert(0, self.syllables[-1].pop())
 				self.syllables.append(newsyll) # Stick it into our list of syllables and start building a coda!
 			else:
@@ -81,6 +98,17 @@ class FrenchWord:
 	
 	def output(self, sep='-', phonsep=''):
 		return sep.join(phonsep.join(p for p in s) for s in self.syllables)
+	
+	def compact(self): # The syllabified word as one string, which is much cheaper to pickle than the object
+		return self.output(sep=SYLLSEP, phonsep=PHONSEP)
+	
+	@classmethod
+	def from_compact(cls, compact): # Rebuild a word from compact() without redoing any of the regex work
+		word = cls.__new__(cls)
+		word.syllables = [syll.split(PHONSEP) for syll in compact.split(SYLLSEP)]
+		word.phonemes = [p for syll in word.syllables for p in syll]
+		word.ipa = ''.join(word.phonemes)
+		return word
 
 # Orthography module
 